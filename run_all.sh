@@ -1,5 +1,6 @@
 #!/usr/bin/env bash
-# Helper script to run summarization on all inputs
+# Helper script to run summarization on all inputs, one at a time.
+# For large runs, `af batch inputs/*.txt` is cheaper and resumable.
 mkdir -p finetuning
 set -eu
 for X in inputs/*.txt; do
@@ -1,27 +1,50 @@
 """High level API for readable-AF"""
 
+from collections.abc import Iterator
 from pathlib import Path
 
+from .external import resilience
 from .model.request import Ctx
 from .output import get_generator
 from .processing import summarization
+from .processing.summarization import Event
 
 DEFAULT_OUT_DIR = Path("./outputs/")
 RERUN_OUT_DIR = Path("./outputs/rerun/")
 
 
 def summarize(ctx: Ctx):
-    """Summarize a document to pptx"""
+    """Summarize a document to pptx, within `ctx.latency_budget` if it is set."""
     input = ctx.input
     assert input.abstract is not None or input.file is not None
-    summary = summarization.summarize(ctx)
-    if ctx.output_file is None:
-        assert ctx.input.file is not None
-        ctx.output_file = (
-            DEFAULT_OUT_DIR / ctx.input.file.stem / f"summary.{ctx.output_format}"
-        )
-    generator = get_generator(ctx.output_format)
-    generator.generate(summary, ctx)
+    with resilience.deadline(ctx.latency_budget):
+        summary = summarization.summarize(ctx)
+        if ctx.output_file is None:
+            assert ctx.input.file is not None
+            ctx.output_file = (
+                DEFAULT_OUT_DIR / ctx.input.file.stem / f"summary.{ctx.output_format}"
+            )
+        generator = get_generator(ctx.output_format)
+        generator.generate(summary, ctx)
+
+
+def summarize_events(ctx: Ctx) -> Iterator[Event]:
+    """Summarize a document, yielding progress as it is made.
+
+    Yields the events of `summarization.summarize_events`, followed by a "progress"
+    event while the output is generated. `ctx.output_file` must be set.
+    All of it is done within `ctx.latency_budget`, if it is set.
+    """
+    assert ctx.output_file is not None
+    with resilience.deadline(ctx.latency_budget):
+        for event in summarization.summarize_events(ctx):
+            if event.summary is not None:
+                ctx.summary = event.summary
+            yield event
+        assert ctx.summary is not None
+        yield Event(kind="progress", data={"message": "Creating document"})
+        generator = get_generator(ctx.output_format)
+        generator.generate(ctx.summary, ctx)
 
 
 def rerun(ctx: Ctx):
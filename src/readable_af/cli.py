@@ -1,16 +1,28 @@
 import copy
+import os
+import shlex
 import subprocess
+import tempfile
+import time
 from pathlib import Path
 import json
 
 import click
+import requests
 
-from readable_af.processing.generation import just_run_summary
+from readable_af.processing.generation import MODEL, just_run_summary, summary_prompt
 
+from .config import Config
+from .errors import AFException
 from .external import caching
+from .external import openai as oa
+from .external.serialization import DEFAULT_SERIALIZER
+from .loadtest import driver, fakes
 from . import api
+from .processing import batch as batch_processing
 from .logger import logger, setup_logging
 from .model.request import Ctx
+from .model.summary import Summary
 
 
 @click.group()
@@ -114,12 +126,318 @@ def rerun(
         print(f"Generated file {ctx.output_file}")
 
 
+@cli.command()
+@click.argument("input_files", type=Path, nargs=-1, required=True)
+@click.option("--out", type=Path, help="output directory", default=api.DEFAULT_OUT_DIR)
+@click.option(
+    "-f",
+    "--format",
+    "formats",
+    type=click.Choice(["yaml", "pptx", "html"]),
+    help="output format",
+    default=["yaml", "pptx"],
+    multiple=True,
+)
+@click.option(
+    "--manifest",
+    type=Path,
+    default=None,
+    help="File tracking the progress of the run [default: OUT/batch-manifest.json]",
+)
+@click.option(
+    "--poll-interval",
+    type=float,
+    default=30,
+    help="Seconds between checks on a submitted batch",
+)
+@click.option(
+    "--retry-failed", is_flag=True, help="Start inputs that failed previously over"
+)
+@click.option(
+    "--base-url",
+    default=None,
+    help="Send API requests to this server instead, e.g. a local stand-in",
+)
+@click.option("-v", "--verbose", count=True)
+def batch(
+    input_files: list[Path],
+    out: Path,
+    formats: list[str],
+    manifest: Path | None,
+    poll_interval: float,
+    retry_failed: bool,
+    base_url: str | None,
+    verbose: int = 0,
+):
+    """Summarize many inputs at once through the OpenAI Batch API.
+
+    Batches are cheaper than individual requests, but can take up to a day.
+    Re-running the same command resumes an interrupted run.
+    """
+    setup_logging(verbose)
+    if base_url is not None:
+        Config.get().openai_base_url = base_url
+    try:
+        result = batch_processing.run(
+            manifest or out / "batch-manifest.json",
+            list(input_files),
+            out,
+            list(formats),
+            poll_interval=poll_interval,
+            retry_failed=retry_failed,
+        )
+    except AFException as e:
+        raise click.ClickException(str(e))
+    for name, entry in result.entries.items():
+        if entry.status == "failed":
+            print(f"Failed to summarize {name}: {entry.error}")
+    n_done = sum(entry.status == "done" for entry in result.entries.values())
+    print(f"Summarized {n_done} of {len(result.entries)} inputs")
+
+
 @cli.command()
 @click.argument("input_file", type=Path)
+@click.option(
+    "--tool-calls",
+    "show_tool_calls",
+    is_flag=True,
+    help="Also print the tool calls the model made to produce the summary",
+)
 @click.option("-v", "--verbose", count=True)
-def test_prompt(input_file: Path, verbose: int = 0):
+def test_prompt(input_file: Path, show_tool_calls: bool = False, verbose: int = 0):
     """Just run the summary_prompt function and print the output."""
     setup_logging(verbose)
     contents = input_file.read_text()
+    if show_tool_calls:
+        run = oa.structured_run(summary_prompt(contents), Summary, MODEL)
+        for call in run.tool_calls:
+            print(f"{call.name}({json.dumps(call.arguments)}) -> {call.output}")
     response = just_run_summary(contents)
-    print(json.dumps(response, indent=2))
+    print(response.model_dump_json(indent=2))
+
+
+@cli.group()
+def cache():
+    """Inspect and maintain the cache."""
+
+
+@cache.command()
+@click.option("--max-bytes", type=int, default=None, help="Override the size budget")
+@click.option(
+    "--max-entries", type=int, default=None, help="Override the entry-count budget"
+)
+@click.option("-v", "--verbose", count=True)
+def gc(max_bytes: int | None, max_entries: int | None, verbose: int = 0):
+    """Evict least recently used cache entries until the cache is within budget."""
+    setup_logging(verbose)
+    store = caching.file_store()
+    if max_bytes is not None:
+        store.max_bytes = max_bytes
+    if max_entries is not None:
+        store.max_entries = max_entries
+    result = store.gc()
+    print(
+        f"Removed {result.n_removed} entries ({result.n_bytes_removed} bytes). "
+        f"{result.n_entries} entries ({result.n_bytes} bytes) remain in {store.root}"
+    )
+
+
+@cache.command()
+@click.option(
+    "--url",
+    default=None,
+    help="Base URL of a running server to fetch live hit/miss/latency stats from",
+)
+@click.option("-v", "--verbose", count=True)
+def stats(url: str | None, verbose: int = 0):
+    """Show how much is cached for each function, and optionally live cache stats."""
+    setup_logging(verbose)
+    for function, (n_entries, n_bytes) in caching.list_functions().items():
+        print(f"{function}: {n_entries} entries, {n_bytes} bytes")
+    if url is not None:
+        response = requests.get(f"{url.rstrip('/')}/api/cache/stats", timeout=10)
+        response.raise_for_status()
+        print(json.dumps(response.json(), indent=2))
+
+
+@cache.command()
+@click.argument("function")
+@click.argument("key", required=False)
+@click.option("-v", "--verbose", count=True)
+def inspect(function: str, key: str | None, verbose: int = 0):
+    """List the cached entries for FUNCTION, or show the entry for KEY."""
+    setup_logging(verbose)
+    if key is None:
+        for entry_key, size, last_used in caching.list_entries(function):
+            used = "" if last_used is None else f", last used {time.ctime(last_used)}"
+            print(f"{entry_key}: {size} bytes{used}")
+        return
+
+    entry = caching.read_entry(function, key)
+    if entry is None:
+        raise click.ClickException(f"No entry {key} cached for {function}")
+    info, data = entry
+    print(f"Arguments: {info}")
+    stored_at = DEFAULT_SERIALIZER.stored_at(data)
+    if stored_at is not None:
+        print(f"Stored at: {time.ctime(stored_at)}")
+    print(f"Size: {len(data)} bytes")
+    print(f"Value: {DEFAULT_SERIALIZER.loads(data)!r}")
+
+
+@cache.command()
+@click.argument("function", required=False)
+@click.argument("key", required=False)
+@click.option("-y", "--yes", is_flag=True, help="Don't ask for confirmation")
+@click.option("-v", "--verbose", count=True)
+def purge(function: str | None, key: str | None, yes: bool, verbose: int = 0):
+    """Delete the entry KEY of FUNCTION, all entries of FUNCTION, or everything."""
+    setup_logging(verbose)
+    target = key or function or "the entire cache"
+    if not yes:
+        click.confirm(f"Delete {target}?", abort=True)
+    n_deleted = caching.purge(function, key)
+    print(f"Deleted {n_deleted} entries")
+
+
+def _fake_services(latencies: list[str], searches: int, bullets: int):
+    try:
+        parsed = {
+            service: fakes.Latency.parse(spec)
+            for service, _, spec in (latency.partition("=") for latency in latencies)
+        }
+    except ValueError:
+        raise click.BadParameter("Latencies must be SERVICE=MEDIAN_MS[:P95_MS]")
+    unknown = parsed.keys() - set(fakes.SERVICES)
+    if unknown:
+        raise click.BadParameter(f"Unknown services {unknown}")
+    return fakes.FakeServices(parsed, n_searches=searches, n_bullets=bullets)
+
+
+def _fake_options(fn):
+    fn = click.option(
+        "--latency",
+        "latencies",
+        multiple=True,
+        help="Latency of a fake service, as SERVICE=MEDIAN_MS[:P95_MS]. "
+        f"Services are {', '.join(fakes.SERVICES)}",
+    )(fn)
+    fn = click.option(
+        "--searches", type=int, default=10, help="Icon searches per summary"
+    )(fn)
+    fn = click.option("--bullets", type=int, default=5, help="Bullets per summary")(fn)
+    return fn
+
+
+def _load_options(fn):
+    fn = click.option("-n", "--requests", "n_requests", type=int, default=50)(fn)
+    fn = click.option("-c", "--concurrency", type=int, default=8)(fn)
+    fn = click.option(
+        "--unique/--repeat",
+        default=True,
+        help="Whether each request summarizes a different abstract, "
+        "or all of them the same one (mostly exercising the cache)",
+    )(fn)
+    return fn
+
+
+@cli.group()
+def loadtest():
+    """Measure throughput and latency against local fake services."""
+
+
+@loadtest.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", type=int, default=8900)
+@_fake_options
+@click.option("-v", "--verbose", count=True)
+def fakes_server(
+    host: str,
+    port: int,
+    latencies: list[str],
+    searches: int,
+    bullets: int,
+    verbose: int = 0,
+):
+    """Serve fake OpenAI, NounProject and Google services until interrupted.
+
+    Start the app with the printed environment to point it at them.
+    """
+    setup_logging(verbose)
+    services = _fake_services(latencies, searches, bullets)
+    server = services.serve(host, port, log_requests=verbose > 0)
+    url = f"http://{host}:{server.port}"
+    cache_dir = tempfile.mkdtemp(prefix="af-loadtest-cache-")
+    for name, value in services.env(url, cache_dir).items():
+        print(f"export {name}={shlex.quote(value)}")
+    print("# Also set FLASK_SECRET_KEY, for both the app and `af loadtest http`.")
+    print(f"# Fakes are being served from {url}. Press Ctrl-C to stop.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+@loadtest.command()
+@click.argument("url")
+@click.option(
+    "--secret-key",
+    envvar="FLASK_SECRET_KEY",
+    required=True,
+    help="The FLASK_SECRET_KEY the app is running with",
+)
+@_load_options
+@click.option("-v", "--verbose", count=True)
+def http(
+    url: str,
+    secret_key: str,
+    n_requests: int,
+    concurrency: int,
+    unique: bool,
+    verbose: int = 0,
+):
+    """Load test /api/summarize on the app at URL.
+
+    The app must be using fake services (see `af loadtest fakes-server`).
+    """
+    setup_logging(verbose)
+    request = driver.http_request(url, secret_key, unique)
+    print(driver.run(request, n_requests, concurrency).format())
+
+
+@loadtest.command()
+@click.option(
+    "-f",
+    "--format",
+    "formats",
+    type=click.Choice(["yaml", "pptx", "html"]),
+    default=["yaml"],
+    multiple=True,
+)
+@_load_options
+@_fake_options
+@click.option("-v", "--verbose", count=True)
+def pipeline(
+    formats: list[str],
+    n_requests: int,
+    concurrency: int,
+    unique: bool,
+    latencies: list[str],
+    searches: int,
+    bullets: int,
+    verbose: int = 0,
+):
+    """Load test the summarization pipeline in this process, as the CLI runs it.
+
+    Fake services are started in this process, with a temporary cache.
+    """
+    setup_logging(verbose)
+    services = _fake_services(latencies, searches, bullets)
+    server = services.serve()
+    with tempfile.TemporaryDirectory(prefix="af-loadtest-cache-") as cache_dir:
+        # Must happen before the config is first read
+        os.environ.update(services.env(f"http://127.0.0.1:{server.port}", cache_dir))
+        request = driver.pipeline_request(list(formats), unique)
+        print(driver.run(request, n_requests, concurrency).format())
+    server.shutdown()
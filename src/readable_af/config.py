@@ -59,6 +59,21 @@ class RequiredEnvVar(EnvVar):
         return value
 
 
+@dataclass(frozen=True)
+class IntEnvVar(EnvVar):
+    """An optional integer config variable, with a default if it is not set."""
+
+    default: int = 0
+
+    @cache
+    def get(self) -> int:  # pyright: ignore[reportIncompatibleVariableOverride]
+        """Return the value of the env var parsed as an int, or the default."""
+        value = super().get()
+        if value is None:
+            return self.default
+        return int(value)
+
+
 @dataclass
 class SecretFile:
     """Holds a reference to config variable that must be written to a file."""
@@ -106,6 +121,24 @@ class Config:
     openai_api_key: str = dataclasses.field(
         default_factory=RequiredEnvVar("OPENAI_API_KEY").get
     )
+    # The following point clients at other servers, e.g. local stand-ins for testing
+    openai_base_url: str | None = dataclasses.field(
+        default_factory=EnvVar("OPENAI_BASE_URL").get
+    )
+    nounproject_base_url: str = dataclasses.field(
+        default_factory=lambda: (
+            EnvVar("NOUNPROJECT_BASE_URL").get() or "https://api.thenounproject.com"
+        )
+    )
+    google_api_root_url: str | None = dataclasses.field(
+        default_factory=EnvVar("GOOGLE_API_ROOT_URL").get
+    )
+    recaptcha_verify_url: str = dataclasses.field(
+        default_factory=lambda: (
+            EnvVar("RECAPTCHA_VERIFY_URL").get()
+            or "https://www.google.com/recaptcha/api/siteverify"
+        )
+    )
     nounproject_api_key: str = dataclasses.field(
         default_factory=RequiredEnvVar("NOUNPROJECT_API_KEY").get
     )
@@ -118,12 +151,43 @@ class Config:
     recapcha_secret: str = dataclasses.field(
         default_factory=RequiredEnvVar("RECAPTCHA_SECRET").get
     )
+    # Signs session cookies, so must be the same across workers and restarts
+    flask_secret_key: str = dataclasses.field(
+        default_factory=RequiredEnvVar("FLASK_SECRET_KEY").get
+    )
     redis_host: str | None = dataclasses.field(
         default_factory=EnvVar("REDIS_URL").get,
     )
     redis_password: str | None = dataclasses.field(
         default_factory=EnvVar("REDIS_PASSWORD").get
     )
+    # Where the on-disk cache is kept, if not in the default location
+    cache_dir: str | None = dataclasses.field(default_factory=EnvVar("CACHE_DIR").get)
+    # Byte budget for the in-process tier of the cache. Set to 0 to disable it.
+    cache_memory_bytes: int = dataclasses.field(
+        default_factory=IntEnvVar("CACHE_MEMORY_BYTES", 64 * 1024 * 1024).get
+    )
+    # Budget for the on-disk cache, beyond which least recently used entries are evicted
+    cache_file_max_bytes: int = dataclasses.field(
+        default_factory=IntEnvVar("CACHE_FILE_MAX_BYTES", 1024 * 1024 * 1024).get
+    )
+    cache_file_max_entries: int = dataclasses.field(
+        default_factory=IntEnvVar("CACHE_FILE_MAX_ENTRIES", 100_000).get
+    )
+    # Set to 1 to serve the cache's stats at /api/cache/stats. They are
+    # unauthenticated, so only enable this where the server isn't public.
+    expose_cache_stats: bool = dataclasses.field(
+        default_factory=lambda: bool(IntEnvVar("EXPOSE_CACHE_STATS", 0).get())
+    )
+
+    # Requests sent to each API across all workers, to stay within its quota.
+    # Set to 0 to disable the limit.
+    openai_requests_per_minute: int = dataclasses.field(
+        default_factory=IntEnvVar("OPENAI_REQUESTS_PER_MINUTE", 500).get
+    )
+    nounproject_requests_per_minute: int = dataclasses.field(
+        default_factory=IntEnvVar("NOUNPROJECT_REQUESTS_PER_MINUTE", 600).get
+    )
 
     _instance: ClassVar["Config| None"] = None
 
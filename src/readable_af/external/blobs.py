@@ -0,0 +1,74 @@
+"""A content-addressed store for icon images.
+
+Each image is stored once on disk, at `<cache dir>/blobs/<hash[:2]>/<hash>`,
+named by the SHA-256 of its bytes, however many icon IDs or summaries refer to
+it. Outputs hard-link images from the store rather than copying them, and the
+bytes and data URIs of recently used images are kept in memory by hash.
+The store is kept in the cache dir, but isn't subject to its garbage collection.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from base64 import b64encode
+from functools import lru_cache
+from pathlib import Path
+
+from .caching import BLOB_DIR, cache_dir
+
+_TMP_PREFIX = ".tmp-"
+
+# Images kept in memory (as bytes and as data URIs). Icons are a few kB each.
+MEMORY_ENTRIES = 512
+
+
+def path(digest: str) -> Path:
+    return cache_dir() / BLOB_DIR / digest[:2] / digest
+
+
+def put(data: bytes) -> str:
+    """Store an image, returning its hash. Storing an image twice is a no-op."""
+    digest = hashlib.sha256(data).hexdigest()
+    target = path(digest)
+    if target.exists():
+        return digest
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=_TMP_PREFIX)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, target)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return digest
+
+
+def exists(digest: str) -> bool:
+    return path(digest).exists()
+
+
+@lru_cache(maxsize=MEMORY_ENTRIES)
+def get(digest: str) -> bytes:
+    """The bytes of a stored image.
+
+    :raises FileNotFoundError: If the image is not in the store
+    """
+    return path(digest).read_bytes()
+
+
+@lru_cache(maxsize=MEMORY_ENTRIES)
+def data_uri(digest: str, mime_type: str = "image/png") -> str:
+    """A data URI holding a stored image, for embedding in HTML."""
+    return f"data:{mime_type};base64,{b64encode(get(digest)).decode('ascii')}"
+
+
+def link(digest: str, dest: Path):
+    """Place a stored image at `dest`, hard-linking it if possible."""
+    dest.unlink(missing_ok=True)
+    try:
+        os.link(path(digest), dest)
+    except OSError:
+        # e.g. the store and `dest` are on different filesystems
+        shutil.copyfile(path(digest), dest)
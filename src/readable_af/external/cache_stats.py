@@ -0,0 +1,129 @@
+"""Counters and latency histograms describing how well cache_af is working.
+
+Stats are kept per process, for each decorated function.
+"""
+
+import bisect
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+@dataclass
+class Histogram:
+    counts: list[int] = field(default_factory=lambda: [0] * (len(BUCKETS_MS) + 1))
+    n: int = 0
+    total_ms: float = 0
+
+    def observe(self, ms: float):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.n += 1
+        self.total_ms += ms
+
+    def quantile(self, q: float) -> float | None:
+        """Approximate a quantile by the upper bound of the bucket it falls in.
+
+        Quantiles beyond the largest bucket are reported as its bound.
+        """
+        if self.n == 0:
+            return None
+        rank = q * self.n
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS_MS[-1]
+
+    def asdict(self) -> dict[str, Any]:
+        buckets = {f"le_{bound}ms": c for bound, c in zip(BUCKETS_MS, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "n": self.n,
+            "mean_ms": self.total_ms / self.n if self.n else None,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "buckets": buckets,
+        }
+
+
+COUNTERS = (
+    "memory_hits",
+    "hits",
+    "misses",
+    "stale_hits",
+    "expired",
+    "verify_rejections",
+    "deserialization_failures",
+    "redis_fallbacks",
+)
+TIMERS = ("backend_read", "backend_write", "compute")
+
+
+class FunctionStats:
+    """Stats for a single cached function."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: dict[str, int] = dict.fromkeys(COUNTERS, 0)
+        self.timers = {name: Histogram() for name in TIMERS}
+
+    def reset(self):
+        with self._lock:
+            self.counters = dict.fromkeys(COUNTERS, 0)
+            self.timers = {name: Histogram() for name in TIMERS}
+
+    def incr(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    @contextmanager
+    def time(self, timer: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.timers[timer].observe(ms)
+
+    def asdict(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = sum(self.counters[c] for c in ("memory_hits", "hits", "misses"))
+            hits = self.counters["memory_hits"] + self.counters["hits"]
+            return {
+                **self.counters,
+                "hit_rate": hits / lookups if lookups else None,
+                **{name: h.asdict() for name, h in self.timers.items()},
+            }
+
+
+_registry: dict[str, FunctionStats] = {}
+_registry_lock = threading.Lock()
+
+
+def for_function(name: str) -> FunctionStats:
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = FunctionStats()
+        return _registry[name]
+
+
+def snapshot() -> dict[str, dict[str, Any]]:
+    """Stats for every cached function in this process."""
+    with _registry_lock:
+        stats = dict(_registry)
+    return {name: s.asdict() for name, s in sorted(stats.items())}
+
+
+def reset():
+    with _registry_lock:
+        stats = list(_registry.values())
+    for s in stats:
+        s.reset()
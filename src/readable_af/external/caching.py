@@ -1,5 +1,13 @@
+import functools
+import inspect
 import json
-import pickle
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from typing import Any, Generic, NamedTuple, ParamSpec, Protocol, TypeVar, cast
 
 from ..config import Config
 import redis
@@ -7,11 +15,199 @@ import hashlib
 from pathlib import Path
 
 from ..logger import logger
+from . import cache_stats, resilience
+from .file_store import FileStore
+from .locks import KeyedLocks, redis_single_flight
+from .serialization import DEFAULT_SERIALIZER, Serializer
 
 CACHE_DIR = Path(__file__).parent.parent.parent / ".cache"
 
 NO_CACHE = False
 
+# Where the blob store (see `blobs`) is kept in the cache dir. The file cache
+# leaves it alone, since blobs aren't cached results.
+BLOB_DIR = "blobs"
+
+# Threads used to read entries from the file cache in get_many
+GET_MANY_FILE_WORKERS = 8
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+# Sentinel for a result that is not present in (or not usable from) the cache
+_MISS = object()
+
+
+class MemoryCache:
+    """A process-local LRU cache of deserialized results.
+
+    Sits in front of the redis and file caches so that hot entries skip the
+    round trip and the deserialization. Entry sizes are approximated by the size
+    of their serialized representation.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[Any, int, float]] = OrderedDict()
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[Any, float] | None:
+        """Return the cached value for key and the time it was stored, if present."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], entry[2]
+
+    def put(self, key: str, value: Any, size: int, stored_at: float):
+        """Store a value, evicting the least recently used entries to stay in budget."""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._n_bytes -= old[1]
+            self._entries[key] = (value, size, stored_at)
+            self._n_bytes += size
+            while self._n_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._n_bytes -= evicted_size
+
+    def discard(self, key: str):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._n_bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._n_bytes = 0
+
+
+@cache
+def rdb() -> redis.Redis | None:
+    """A redis client shared by all cached functions, or None if redis isn't configured.
+
+    All clients draw from one connection pool, so connections are reused across
+    cached functions and calls.
+    """
+    redis_host = Config.get().redis_host
+    redis_password = Config.get().redis_password
+    if not redis_host:
+        return None
+    assert redis_password
+    pool = redis.ConnectionPool(
+        host=redis_host,
+        username="default",
+        password=redis_password,
+        port=6379,
+        db=0,
+        socket_connect_timeout=5,
+        socket_timeout=5,
+        health_check_interval=30,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+def cache_dir() -> Path:
+    """Where on-disk caches are kept."""
+    cfg = Config.get()
+    return Path(cfg.cache_dir) if cfg.cache_dir else CACHE_DIR
+
+
+@cache
+def file_store() -> FileStore:
+    """The on-disk cache, used when redis is not configured or unavailable."""
+    cfg = Config.get()
+    return FileStore(
+        cache_dir(),
+        cfg.cache_file_max_bytes,
+        cfg.cache_file_max_entries,
+        exclude=(BLOB_DIR,),
+    )
+
+
+@cache
+def memory_cache() -> MemoryCache:
+    """The in-process cache tier, shared by all cached functions."""
+    return MemoryCache(Config.get().cache_memory_bytes)
+
+
+def _redis_entry_keys(function: str | None = None) -> Iterator[str]:
+    """Yield the redis keys holding cached results, optionally for one function."""
+    client = rdb()
+    assert client is not None
+    match = "*" if function is None else f"{function.strip('_')}:*"
+    for key in client.scan_iter(match=match, count=1000):
+        key = key.decode("utf-8")
+        if ":" in key and not key.endswith(("-info", "-lock")):
+            yield key
+
+
+def list_entries(function: str) -> list[tuple[str, int, float | None]]:
+    """List the key, size and last-used time (if known) of a function's entries."""
+    client = rdb()
+    if client is None:
+        return list(file_store().entries(function))
+    keys = list(_redis_entry_keys(function))
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.strlen(key)
+    sizes = pipe.execute()
+    return [(key.split(":", 1)[1], size, None) for key, size in zip(keys, sizes)]
+
+
+def list_functions() -> dict[str, tuple[int, int]]:
+    """Map each function with cached results to its number of entries and bytes."""
+    usage: dict[str, tuple[int, int]] = {}
+    if rdb() is None:
+        functions = file_store().namespaces()
+    else:
+        functions = sorted({k.split(":", 1)[0] for k in _redis_entry_keys()})
+    for function in functions:
+        entries = list_entries(function)
+        if entries:
+            usage[function] = (len(entries), sum(size for _, size, _ in entries))
+    return usage
+
+
+def read_entry(function: str, key: str) -> tuple[str, bytes] | None:
+    """Read the info and serialized value of a single cached result."""
+    client = rdb()
+    if client is None:
+        return file_store().get(function, key)
+    redis_key = f"{function.strip('_')}:{key}"
+    resp, info_resp = cast(list, client.mget(redis_key, f"{redis_key}-info"))
+    if not isinstance(resp, bytes) or not isinstance(info_resp, bytes):
+        return None
+    return info_resp.decode("utf-8"), resp
+
+
+def purge(function: str | None = None, key: str | None = None) -> int:
+    """Delete cached results, for one entry, one function, or everything.
+
+    :returns: The number of entries deleted
+    """
+    memory_cache().clear()
+    client = rdb()
+    if client is None:
+        store = file_store()
+        if function is None:
+            return sum(store.delete(f) for f in store.namespaces())
+        return store.delete(function, key)
+    if key is not None:
+        assert function is not None
+        keys = [f"{function.strip('_')}:{key}"]
+    else:
+        keys = list(_redis_entry_keys(function))
+    for i in range(0, len(keys), 1000):
+        batch = keys[i : i + 1000]
+        client.delete(*batch, *(f"{k}-info" for k in batch))
+    return len(keys)
+
 
 def _make_hashable(x):
     if isinstance(x, (list, tuple)):
@@ -21,134 +217,407 @@ def _make_hashable(x):
     return x
 
 
-def cache_af(version: str = "", verify_fn=None):
+class _Call(NamedTuple):
+    """A call to a cached function, along with the keys identifying its result."""
+
+    memory_key: str
+    hash_value: str
+    to_hash: Any
+    args: tuple
+    kwargs: dict[str, Any]
+
+
+class CachedFunction(Protocol, Generic[P, R]):
+    """A function decorated with `cache_af`."""
+
+    stats: cache_stats.FunctionStats
+
+    def __call__(self, *args: P.args, **kwargs: P.kwargs) -> R: ...
+
+    def get_many(
+        self, calls: Sequence[dict[str, Any]], compute_missing: bool = True
+    ) -> list[R | None]: ...
+
+    def invalidate(self, *args: P.args, **kwargs: P.kwargs) -> None: ...
+
+
+def cache_af(
+    version: str = "",
+    verify_fn=None,
+    serializer: Serializer = DEFAULT_SERIALIZER,
+    single_flight: bool = False,
+    single_flight_timeout: float = 120,
+    key_fn=None,
+    ttl: float | None = None,
+    stale_ttl: float | None = None,
+    namespace: str | None = None,
+) -> Callable[[Callable[P, R]], CachedFunction[P, R]]:
     """A decorator to cache the results of a function call locally.
 
     Results are either cached locally or in redis, depending on the configuration.
+    Recently used results are additionally held in memory, up to
+    `Config.cache_memory_bytes`.
     :param version: can be used to invalidate the cache for a given function.
     :param verify_fn: If provided, this function will be called on results
            falsy results will never be cached.
+    :param serializer: Converts results to and from the bytes stored in the cache.
+    :param single_flight: If True, concurrent calls that miss the cache with the same
+           arguments are coalesced so that only one of them computes the result.
+           Other threads wait on an in-process lock, and other processes on a
+           lock in redis (if configured).
+    :param single_flight_timeout: How long a single-flight computation may hold its
+           lock before waiters give up on it and compute the result themselves.
+           Waiters also give up if the current deadline (see `resilience`) passes.
+    :param key_fn: If provided, called with the function's arguments to produce the
+           JSON-serializable value that identifies the result in the cache.
+           By default, all arguments are used.
+    :param ttl: If provided, results older than this many seconds are stale.
+    :param stale_ttl: For how many seconds after `ttl` a stale result is still
+           returned. Returning a stale result triggers a refresh in the background.
+           Results older than `ttl + stale_ttl` are recomputed before returning.
+    :param namespace: Where the function's results are kept in the cache. Defaults
+           to the function's name. Set it to keep using existing results when
+           renaming a function.
+
+    The decorated function also has a `get_many(calls)` method, which takes a list
+    of keyword argument dicts and returns the corresponding results, looking them
+    all up in a single cache operation (sharing results with calls that pass
+    the same arguments by position), and an `invalidate` method, which takes
+    the same arguments as the function and deletes the cached result for them.
 
     """
+    # Results older than this (in seconds) are never returned
+    max_age = None if ttl is None else ttl + (stale_ttl or 0)
 
-    def decorator(fn):
-        redis_host = Config.get().redis_host
-        redis_password = Config.get().redis_password
-        if redis_host is not None:
-            assert redis_password
-            rdb = redis.Redis(
-                host=redis_host,
-                username="default",
-                password=redis_password,
-                port=6379,
-                db=0,
-            )
-        else:
-            rdb = None
+    def decorator(fn: Callable[P, R]) -> CachedFunction[P, R]:
+        fn_namespace = namespace or fn.__name__
+        fn_cache = fn_namespace.strip("_")
+        signature = inspect.signature(fn)
+        inflight = KeyedLocks()
+        stats = cache_stats.for_function(f"{fn.__module__}.{fn.__qualname__}")
+        # Memory keys of results being refreshed in the background
+        refreshing: set[str] = set()
+        refreshing_lock = threading.Lock()
 
-        def redis_cache(*args, **kwargs) -> tuple[str, bool]:
-            kwargs["__version__"] = version
-            fn_cache = fn.__name__.strip("_")
-            to_hash = _make_hashable((args, kwargs))
-            hash_value = hashlib.md5(str(to_hash).encode("utf-8")).hexdigest()
-            key = f"{fn_cache}:{hash_value}"
+        def usable(call: _Call, stored_at: float | None, source: str) -> bool:
+            """Check whether a result stored at a given time can be returned.
+
+            Stale results can be, but also kick off a background refresh.
+            """
+            if ttl is None:
+                return True
+            age = None if stored_at is None else time.time() - stored_at
+            if age is None or (max_age is not None and age > max_age):
+                logger.debug(f"Cached result for {source} has expired")
+                stats.incr("expired")
+                return False
+            if age > ttl:
+                logger.debug(f"Cached result for {source} is stale")
+                stats.incr("stale_hits")
+                refresh(call)
+            return True
+
+        def load(call: _Call, data: bytes, source: str):
+            """Deserialize and verify a cached result. Returns _MISS if unusable."""
+            stored_at = serializer.stored_at(data)
+            if not usable(call, stored_at, source):
+                return _MISS
+            try:
+                loaded = serializer.loads(data)
+            except Exception as e:
+                logger.warning(
+                    f"Error loading cache entry {source}. Continuing without it: {e}"
+                )
+                stats.incr("deserialization_failures")
+                return _MISS
+            if verify_fn is not None and not verify_fn(loaded):
+                logger.debug(f"Cached result for {source} failed verification")
+                stats.incr("verify_rejections")
+                return _MISS
+            stats.incr("hits")
+            if stored_at is None:
+                stored_at = time.time()
+            memory_cache().put(call.memory_key, loaded, len(data), stored_at)
+            return loaded
+
+        def remember(memory_key: str, value, size: int):
+            """Keep a result in memory if it would be served from the cache."""
+            if verify_fn is None or verify_fn(value):
+                memory_cache().put(memory_key, value, size, time.time())
+
+        def compute(call: _Call, store):
+            """Call the wrapped function and cache its result with `store`."""
+            stats.incr("misses")
+            with stats.time("compute"):
+                result = fn(*call.args, **call.kwargs)
+            data = serializer.dumps(result)
+            with stats.time("backend_write"):
+                store(call, data)
+            remember(call.memory_key, result, len(data))
+            return result
+
+        def refresh(call: _Call):
+            """Recompute a stale result in a background thread."""
+            with refreshing_lock:
+                if call.memory_key in refreshing:
+                    return
+                refreshing.add(call.memory_key)
+
+            def run():
+                try:
+                    compute(call, backend_store)
+                except Exception:
+                    logger.exception(f"Error refreshing {call.memory_key}")
+                finally:
+                    with refreshing_lock:
+                        refreshing.discard(call.memory_key)
+
+            threading.Thread(target=run, daemon=True).start()
+
+        def check_redis_entry(call: _Call, key: str, resp, info_resp):
+            """Load a result fetched from redis, if its info matches the arguments."""
+            # The client doesn't decode responses, so anything found is bytes
+            if not isinstance(resp, bytes) or not isinstance(info_resp, bytes):
+                return _MISS
+            info = _make_hashable(json.loads(info_resp.decode("utf-8")))
+            if info != call.to_hash:
+                logger.warning("Something weird happened. Cache info doesn't match.")
+                logger.warning("Expected: %s", call.to_hash)
+                logger.warning("Got: %s", info)
+                return _MISS
+            logger.debug("Info matches")
+            return load(call, resp, key)
+
+        def redis_lookup(call: _Call):
+            """Fetch a cached result and its info from redis in one round trip."""
+            key = f"{fn_cache}:{call.hash_value}"
             info_key = f"{key}-info"
-            assert rdb is not None
             logger.debug(f"Checking redis cache for key {key} and {info_key}")
+            client = rdb()
+            assert client is not None
+            with stats.time("backend_read"):
+                resp, info_resp = cast(list, client.mget(key, info_key))
+            return check_redis_entry(call, key, resp, info_resp)
+
+        def redis_store(call: _Call, data: bytes):
+            """Write a serialized result and its info to redis in one round trip."""
+            key = f"{fn_cache}:{call.hash_value}"
+            client = rdb()
+            assert client is not None
+            try:
+                # Let redis reclaim entries once they can no longer be used
+                expiry = None if max_age is None else int(max_age)
+                pipe = client.pipeline(transaction=False)
+                pipe.set(key, data, ex=expiry)
+                pipe.set(f"{key}-info", json.dumps(call.to_hash), ex=expiry)
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.warning(f"Error writing {key} to redis. Not caching: {e}")
 
-            if rdb.exists(info_key) and rdb.exists(key):
-                resp = rdb.get(info_key)
-                assert isinstance(resp, bytes)
-                resp = resp.decode("utf-8")
-                info = _make_hashable(json.loads(resp))
-                if info == to_hash:
-                    logger.debug("Info matches")
-                    return key, True
+        def redis_cache_wrapper(call: _Call):
+            value = _MISS if NO_CACHE else redis_lookup(call)
+            logger.debug(f"Cache exists? {value is not _MISS}")
+            if value is not _MISS:
+                return value
+            if not single_flight or NO_CACHE:
+                return compute(call, redis_store)
+
+            client = rdb()
+            assert client is not None
+            with redis_single_flight(
+                client,
+                f"{fn_cache}:{call.hash_value}",
+                single_flight_timeout,
+                poll=lambda: redis_lookup(call),
+                miss=_MISS,
+                max_wait=single_flight_wait(),
+            ) as value:
+                if value is not _MISS:
+                    return value
+                return compute(call, redis_store)
+
+        def file_lookup(call: _Call):
+            with stats.time("backend_read"):
+                entry = file_store().get(fn_namespace, call.hash_value)
+            if entry is None:
+                return _MISS
+            stored_info, data = entry
+            info = json.dumps(call.to_hash)
+            if stored_info != info:
                 logger.warning("Something weird happened. Cache info doesn't match.")
-                logger.warning("Expected: %s", to_hash)
-                logger.warning("Got: %s", info)
-            rdb.set(info_key, json.dumps(to_hash))
-            return key, False
-
-        def cache_file(*args, **kwargs) -> tuple[Path, bool]:
-            kwargs["__version__"] = version
-            fn_cache = CACHE_DIR / fn.__name__
-            if not fn_cache.exists():
-                fn_cache.mkdir(parents=True, exist_ok=True)
-
-            to_hash = _make_hashable((args, kwargs))
-            h = hashlib.md5(str(to_hash).encode("utf-8")).hexdigest()
-            cache_file = fn_cache / str(h)
-            cache_info = cache_file.with_suffix(".json")
-
-            if cache_file.exists() and cache_info.exists():
-                logger.debug(f"Cache info exists: {cache_info}")
-                with cache_info.open() as f:
-                    info = _make_hashable(json.load(f))
-                    if info == to_hash:
-                        logger.debug("Info matches")
-                        return cache_file, True
+                logger.warning("Expected: %s", info)
+                logger.warning("Got: %s", stored_info)
+                return _MISS
+            return load(call, data, call.hash_value)
+
+        def file_store_result(call: _Call, data: bytes):
+            info = json.dumps(call.to_hash)
+            file_store().put(fn_namespace, call.hash_value, info, data)
+
+        def file_cache_wrapper(call: _Call):
+            value = _MISS if NO_CACHE else file_lookup(call)
+            logger.debug(f"Cache exists? {value is not _MISS}")
+            if value is not _MISS:
+                return value
+            return compute(call, file_store_result)
+
+        def backend_store(call: _Call, data: bytes):
+            if rdb() is not None:
+                redis_store(call, data)
+            else:
+                file_store_result(call, data)
+
+        def backend_wrapper(call: _Call):
+            if rdb() is not None:
+                try:
+                    return redis_cache_wrapper(call)
+                except redis.RedisError as e:
                     logger.warning(
-                        "Something weird happened. Cache info doesn't match."
+                        f"Redis error! Falling back to file cache. Error: {e}"
                     )
-                    logger.warning("Expected: %s", to_hash)
-                    logger.warning("Got: %s", info)
-
-            with cache_info.open("w") as f:
-                json.dump(to_hash, f, indent=2)
-            return cache_file, False
-
-        def redis_cache_wrapper(*args, **kwargs):
-            assert rdb is not None
-            c_f, is_cached = redis_cache(*args, **kwargs)
-            logger.debug(f"Cache file: {c_f}")
-            logger.debug(f"Cache exists? {is_cached}")
-            if is_cached and not NO_CACHE:
-                resp = rdb.get(c_f)
-                try:
-                    assert isinstance(resp, bytes)
-                    loaded = pickle.loads(resp)
-                    if verify_fn is not None:
-                        if not verify_fn(loaded):
-                            reran = fn(*args, **kwargs)
-                            rdb.set(c_f, pickle.dumps(reran))
-                            return reran
-                    return pickle.loads(resp)
-                except Exception as e:
+                    stats.incr("redis_fallbacks")
+            return file_cache_wrapper(call)
+
+        def memory_lookup(call: _Call):
+            if NO_CACHE:
+                return _MISS
+            entry = memory_cache().get(call.memory_key)
+            if entry is None or not usable(call, entry[1], call.memory_key):
+                return _MISS
+            # Results can stop verifying while in memory, e.g. if a file they
+            # refer to is deleted
+            if verify_fn is not None and not verify_fn(entry[0]):
+                logger.debug(
+                    f"In-memory result for {call.memory_key} failed verification"
+                )
+                stats.incr("verify_rejections")
+                memory_cache().discard(call.memory_key)
+                return _MISS
+            logger.debug(f"In-memory cache hit for {call.memory_key}")
+            stats.incr("memory_hits")
+            return entry[0]
+
+        def single_flight_wait() -> float:
+            """How long to wait for a concurrent computation of the same result."""
+            left = resilience.remaining()
+            return (
+                single_flight_timeout
+                if left is None
+                else min(single_flight_timeout, left)
+            )
+
+        def cached_call(call: _Call):
+            """Get a result that isn't in memory from the backends, or compute it."""
+            if not single_flight:
+                return backend_wrapper(call)
+            with inflight.hold(call.memory_key, single_flight_wait()) as held:
+                if not held:
                     logger.warning(
-                        f"Error loading cache file {c_f}. Continuing without it: {e}"
+                        f"Timed out waiting for {call.memory_key}. Computing anyway."
                     )
-            result = fn(*args, **kwargs)
-            rdb.set(c_f, pickle.dumps(result))
-            return result
+                    return backend_wrapper(call)
+                # Another thread may have computed the result while we waited
+                value = memory_lookup(call)
+                if value is not _MISS:
+                    return value
+                return backend_wrapper(call)
 
-        def file_cache_wrapper(*args, **kwargs):
-            c_f, is_cached = cache_file(*args, **kwargs)
-            logger.debug(f"Cache file: {c_f}")
-            logger.debug(f"Cache exists? {is_cached}")
-            if is_cached and not NO_CACHE:
-                with c_f.open("rb") as f:
-                    try:
-                        return pickle.load(f)
-                    except Exception as e:
-                        logger.warning(
-                            f"Error loading cache file {c_f}. Continuing without it: {e}"
-                        )
-            result = fn(*args, **kwargs)
-            with c_f.open("wb") as f:
-                pickle.dump(result, f)
-            return result
+        def make_call(args, kwargs) -> _Call:
+            if key_fn is not None:
+                key_args = key_fn(*args, **kwargs)
+                to_hash = _make_hashable((key_args, {"__version__": version}))
+            else:
+                to_hash = _make_hashable((args, {**kwargs, "__version__": version}))
+            hash_value = hashlib.md5(str(to_hash).encode("utf-8")).hexdigest()
+            memory_key = f"{fn.__module__}.{fn.__qualname__}:{hash_value}"
+            return _Call(memory_key, hash_value, to_hash, args, kwargs)
 
+        @functools.wraps(fn)
         def wrapper(*args, **kwargs):
-            if rdb is not None:
+            call = make_call(args, kwargs)
+            value = memory_lookup(call)
+            if value is not _MISS:
+                return value
+            return cached_call(call)
+
+        def backend_get_many(pending: list[_Call]) -> list:
+            """Look up several results in the backends with a single operation."""
+            client = rdb()
+            if client is not None:
+                redis_keys = [f"{fn_cache}:{call.hash_value}" for call in pending]
                 try:
-                    return redis_cache_wrapper(*args, **kwargs)
-                except redis.ResponseError as e:
+                    with stats.time("backend_read"):
+                        resps = cast(
+                            list,
+                            client.mget(
+                                *redis_keys, *(f"{key}-info" for key in redis_keys)
+                            ),
+                        )
+                    return [
+                        check_redis_entry(call, key, resp, info_resp)
+                        for call, key, resp, info_resp in zip(
+                            pending, redis_keys, resps, resps[len(pending) :]
+                        )
+                    ]
+                except redis.RedisError as e:
                     logger.warning(
                         f"Redis error! Falling back to file cache. Error: {e}"
                     )
-            return file_cache_wrapper(*args, **kwargs)
+                    stats.incr("redis_fallbacks")
+            with ThreadPoolExecutor(max_workers=GET_MANY_FILE_WORKERS) as pool:
+                return list(pool.map(file_lookup, pending))
+
+        def get_many(
+            calls: Sequence[dict[str, Any]], compute_missing: bool = True
+        ) -> list:
+            """Get the results of calling the function with each set of keyword args.
+
+            Results are looked up in a single backend operation, and only the
+            misses are computed. With single_flight, misses still coordinate with
+            concurrent callers, which re-checks the backend for each of them.
+
+            :param compute_missing: If False, misses are returned as None rather
+                   than computed, so that the caller can compute them as it likes
+            """
+            # Keyword arguments that can be passed by position are, as that's how
+            # the function is usually called, so that those calls' results are found
+            bound = [signature.bind(**kwargs) for kwargs in calls]
+            keyed = [make_call(b.args, b.kwargs) for b in bound]
+            results = [memory_lookup(call) for call in keyed]
+            pending = [i for i, value in enumerate(results) if value is _MISS]
+            if pending and not NO_CACHE:
+                found = backend_get_many([keyed[i] for i in pending])
+                for i, value in zip(pending, found):
+                    results[i] = value
+                pending = [i for i in pending if results[i] is _MISS]
+            logger.debug(f"{len(pending)} of {len(calls)} results missing from cache")
+
+            if not compute_missing:
+                return [None if value is _MISS else value for value in results]
+            for i in pending:
+                if single_flight:
+                    results[i] = cached_call(keyed[i])
+                else:
+                    results[i] = compute(keyed[i], backend_store)
+            return results
+
+        def invalidate(*args, **kwargs):
+            """Delete the cached result of calling the function with these arguments."""
+            call = make_call(args, kwargs)
+            memory_cache().discard(call.memory_key)
+            client = rdb()
+            if client is not None:
+                key = f"{fn_cache}:{call.hash_value}"
+                try:
+                    client.delete(key, f"{key}-info")
+                except redis.RedisError as e:
+                    logger.warning(f"Error deleting {key} from redis: {e}")
+            file_store().delete(fn_namespace, call.hash_value)
 
-        return wrapper
+        cached = cast(CachedFunction[P, R], wrapper)
+        cached.get_many = get_many
+        cached.invalidate = invalidate
+        cached.stats = stats
+        return cached
 
     return decorator
@@ -0,0 +1,200 @@
+"""A bounded on-disk store for cached results.
+
+Entries live at `<root>/<namespace>/<key[:2]>/<key>` so that no single directory
+grows too large. Each entry is one file holding a line of JSON info followed by
+the payload, and is written to a temporary file and renamed into place so that
+readers never see a partial entry. Entries are evicted least-recently-used
+first once the store grows past its size or entry-count budget.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Collection, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+from ..logger import logger
+
+_TMP_PREFIX = ".tmp-"
+
+# Temporary files older than this were left behind by a crashed writer
+_STALE_TMP_SECONDS = 60 * 60
+
+# Run a background garbage collection after this many writes in a process
+GC_EVERY_N_WRITES = 256
+
+
+@dataclass
+class GCResult:
+    n_entries: int = 0
+    n_bytes: int = 0
+    n_removed: int = 0
+    n_bytes_removed: int = 0
+
+
+class FileStore:
+    """Cached results on disk, bounded by `max_bytes` and `max_entries`.
+
+    :param exclude: Directories in `root` that hold something else, and so are
+           neither namespaces nor garbage collected
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        max_bytes: int,
+        max_entries: int,
+        exclude: Collection[str] = (),
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.exclude = frozenset(exclude)
+        self._n_writes = 0
+        self._gc_lock = threading.Lock()
+
+    def path(self, namespace: str, key: str) -> Path:
+        return self.root / namespace / key[:2] / key
+
+    def get(self, namespace: str, key: str) -> tuple[str, bytes] | None:
+        """Read an entry, returning its info and payload, or None if it is missing."""
+        path = self.path(namespace, key)
+        try:
+            data = path.read_bytes()
+            # Mark the entry as recently used for eviction purposes
+            os.utime(path)
+        except FileNotFoundError:
+            return self._get_legacy(namespace, key)
+        info, sep, payload = data.partition(b"\n")
+        if not sep:
+            logger.warning(f"Cache entry {path} is malformed. Ignoring it.")
+            return None
+        return info.decode("utf-8"), payload
+
+    def _get_legacy(self, namespace: str, key: str) -> tuple[str, bytes] | None:
+        """Read and migrate an entry from the old flat `<namespace>/<key>` layout."""
+        legacy = self.root / namespace / key
+        legacy_info = legacy.with_suffix(".json")
+        try:
+            payload = legacy.read_bytes()
+            # Legacy info files were pretty-printed, but entries hold it on one line
+            info = json.dumps(json.loads(legacy_info.read_text()))
+        except FileNotFoundError:
+            return None
+        logger.debug(f"Migrating legacy cache entry {legacy}")
+        self.put(namespace, key, info, payload)
+        legacy.unlink(missing_ok=True)
+        legacy_info.unlink(missing_ok=True)
+        return info, payload
+
+    def put(self, namespace: str, key: str, info: str, payload: bytes):
+        """Atomically write an entry. `info` must not contain a newline."""
+        assert "\n" not in info
+        path = self.path(namespace, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=_TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(info.encode("utf-8"))
+                f.write(b"\n")
+                f.write(payload)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+        self._n_writes += 1
+        if self._n_writes % GC_EVERY_N_WRITES == 0:
+            threading.Thread(target=self.gc, daemon=True).start()
+
+    def namespaces(self) -> list[str]:
+        if not self.root.exists():
+            return []
+        return sorted(
+            p.name
+            for p in self.root.iterdir()
+            if p.is_dir() and p.name not in self.exclude
+        )
+
+    def entries(self, namespace: str) -> Iterator[tuple[str, int, float]]:
+        """Yield the key, size and last-used time of each entry in a namespace."""
+        for path in (self.root / namespace).glob("??/*"):
+            if path.name.startswith(_TMP_PREFIX):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            yield path.name, stat.st_size, stat.st_mtime
+
+    def delete(self, namespace: str, key: str | None = None) -> int:
+        """Delete one entry, or every entry in a namespace if no key is given.
+
+        :returns: The number of entries deleted
+        """
+        if key is not None:
+            path = self.path(namespace, key)
+            existed = path.exists()
+            path.unlink(missing_ok=True)
+            return int(existed)
+        n_deleted = 0
+        for dirpath, _, filenames in os.walk(self.root / namespace):
+            for filename in filenames:
+                (Path(dirpath) / filename).unlink(missing_ok=True)
+                n_deleted += not filename.startswith(_TMP_PREFIX)
+        return n_deleted
+
+    def gc(self) -> GCResult:
+        """Evict least-recently-used entries until the store is within budget.
+
+        Leftover temporary files from crashed writers are removed as well.
+        Only one collection runs at a time; concurrent calls return immediately.
+        """
+        result = GCResult()
+        if not self._gc_lock.acquire(blocking=False):
+            return result
+        try:
+            entries: list[tuple[float, int, Path]] = []
+            now = time.time()
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                # Entries are all in namespaces; other files in the root aren't ours
+                if Path(dirpath) == self.root:
+                    dirnames[:] = [d for d in dirnames if d not in self.exclude]
+                    continue
+                for filename in filenames:
+                    path = Path(dirpath) / filename
+                    try:
+                        stat = path.stat()
+                    except FileNotFoundError:
+                        continue
+                    if filename.startswith(_TMP_PREFIX):
+                        if now - stat.st_mtime > _STALE_TMP_SECONDS:
+                            path.unlink(missing_ok=True)
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+            result.n_entries = len(entries)
+            result.n_bytes = sum(size for _, size, _ in entries)
+            entries.sort()
+            for _, size, path in entries:
+                if (
+                    result.n_bytes <= self.max_bytes
+                    and result.n_entries <= self.max_entries
+                ):
+                    break
+                path.unlink(missing_ok=True)
+                result.n_entries -= 1
+                result.n_bytes -= size
+                result.n_removed += 1
+                result.n_bytes_removed += size
+        finally:
+            self._gc_lock.release()
+        if result.n_removed:
+            logger.info(
+                f"Evicted {result.n_removed} cache entries "
+                f"({result.n_bytes_removed} bytes) from {self.root}"
+            )
+        return result
@@ -0,0 +1,89 @@
+"""A shared client for outbound HTTP requests (other than to OpenAI).
+
+All requests go through one session, which keeps a pool of keep-alive
+connections to each host, so repeated calls to an API skip the TCP and TLS
+handshakes. Requests time out by default, and failures to connect, as well as
+server errors on idempotent requests, are retried with a short backoff.
+"""
+
+import os
+import threading
+from functools import cache
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1
+from urllib3.util.retry import Retry
+
+# Seconds to wait to connect, and then between bytes of the response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# Hosts to keep connection pools for, and connections kept open to each host.
+# Icons are downloaded in parallel, so this should cover the number of workers.
+POOL_HOSTS = 10
+POOL_SIZE = 32
+
+# Longest wait between retries, in seconds
+BACKOFF_MAX = 4
+
+RETRY = Retry(
+    total=3,
+    # A server that was too slow once is likely to be again
+    read=1,
+    backoff_factor=0.5,
+    backoff_max=BACKOFF_MAX,
+    # Connection errors are retried for any method; these only for idempotent ones.
+    # Rate limits (429) aren't retried here: requests wait for their turn under
+    # `rate_limit` instead, which respects the caller's deadline.
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+    # Retry-After isn't capped by backoff_max, so it could stall a request
+    respect_retry_after_header=False,
+    raise_on_status=False,
+)
+
+
+class _Session(requests.Session):
+    """A session that applies the default timeouts to requests that don't set one."""
+
+    def request(self, method, url, **kwargs):  # pyright: ignore[reportIncompatibleMethodOverride]
+        kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+        return super().request(method, url, **kwargs)
+
+
+_session: requests.Session | None = None
+_session_pid: int | None = None
+_session_lock = threading.Lock()
+
+
+def session() -> requests.Session:
+    """The session shared by all outbound requests in this process.
+
+    A new session is made after a fork, so that workers never share connections.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            new = _Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, max_retries=RETRY
+            )
+            new.mount("https://", adapter)
+            new.mount("http://", adapter)
+            _session, _session_pid = new, os.getpid()
+        return _session
+
+
+@cache
+def oauth1(key: str, secret: str) -> OAuth1:
+    """An OAuth1 signer for a consumer key and secret, built once and reused."""
+    return OAuth1(key, secret)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return session().get(url, **kwargs)
+
+
+def post(url: str, data=None, **kwargs) -> requests.Response:
+    return session().post(url, data, **kwargs)
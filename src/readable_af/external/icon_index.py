@@ -0,0 +1,156 @@
+"""A local full-text index of the icons returned by nounproject searches.
+
+Every icon seen in a search result is indexed by its tags and collection names
+(with SQLite's FTS5), so that later searches for related terms can be answered
+from disk rather than the API. Results are ranked with BM25, weighting tags
+above collection names.
+
+Icons are stored as the keyword arguments of `nounproject.IconSearchResult`.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+
+from ..logger import logger
+from .caching import cache_dir
+
+ENABLED = True
+INDEX_FILE = "icon_index.sqlite3"
+
+# Relative weight of matches in tags and in collection names when ranking
+TAG_WEIGHT = 10.0
+COLLECTION_WEIGHT = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS icons (
+    id TEXT PRIMARY KEY,
+    tags TEXT NOT NULL,
+    collection_names TEXT NOT NULL,
+    seen_at REAL NOT NULL
+);
+-- Rows share the rowid of the icon they index
+CREATE VIRTUAL TABLE IF NOT EXISTS icons_fts USING fts5(
+    tags, collection_names, tokenize = 'porter unicode61'
+);
+CREATE TABLE IF NOT EXISTS queries (
+    query TEXT PRIMARY KEY,
+    n_results INTEGER NOT NULL,
+    searched_at REAL NOT NULL
+);
+"""
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def _connection() -> sqlite3.Connection | None:
+    """This thread's connection to the index, or None if it can't be used."""
+    if not ENABLED:
+        return None
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.conn = None
+        path = cache_dir() / INDEX_FILE
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            _local.conn = conn
+        except sqlite3.Error as e:
+            logger.warning(f"Icon index at {path} is unavailable: {e}")
+    return _local.conn
+
+
+def _match(query: str) -> str:
+    """An FTS5 query matching icons that contain every term of a search query."""
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    return " AND ".join(terms)
+
+
+def add(query: str, results: list[dict[str, Any]]):
+    """Index the results of a search made through the API."""
+    conn = _connection()
+    if conn is None:
+        return
+    now = time.time()
+    try:
+        with _write_lock, conn:
+            for result in results:
+                (rowid,) = conn.execute(
+                    "INSERT INTO icons VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE "
+                    "SET tags = excluded.tags, "
+                    "collection_names = excluded.collection_names, "
+                    "seen_at = excluded.seen_at "
+                    "RETURNING rowid",
+                    (
+                        result["id_"],
+                        json.dumps(result["tags"]),
+                        json.dumps(result["collection_names"]),
+                        now,
+                    ),
+                ).fetchone()
+                conn.execute("DELETE FROM icons_fts WHERE rowid = ?", (rowid,))
+                conn.execute(
+                    "INSERT INTO icons_fts (rowid, tags, collection_names) VALUES (?, ?, ?)",
+                    (
+                        rowid,
+                        " ; ".join(result["tags"]),
+                        " ; ".join(result["collection_names"]),
+                    ),
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?)",
+                (query, len(results), now),
+            )
+    except sqlite3.Error as e:
+        logger.warning(f"Could not index results for '{query}': {e}")
+
+
+def searched(query: str) -> bool:
+    """Whether results for a query have been indexed from the API."""
+    conn = _connection()
+    if conn is None:
+        return False
+    try:
+        row = conn.execute("SELECT 1 FROM queries WHERE query = ?", (query,)).fetchone()
+    except sqlite3.Error:
+        return False
+    return row is not None
+
+
+def search(query: str, limit: int, min_results: int) -> list[dict[str, Any]] | None:
+    """Search the index for icons matching every term of a query.
+
+    :param min_results: Fewer matches than this means the index doesn't cover
+           the query well enough, and None is returned instead
+    :returns: Up to `limit` of the best matching icons, best first
+    """
+    conn = _connection()
+    if conn is None or not query.strip():
+        return None
+    try:
+        rows = conn.execute(
+            "SELECT icons.id, icons.tags, icons.collection_names "
+            "FROM icons_fts JOIN icons ON icons.rowid = icons_fts.rowid "
+            "WHERE icons_fts MATCH ? "
+            "ORDER BY bm25(icons_fts, ?, ?) LIMIT ?",
+            (_match(query), TAG_WEIGHT, COLLECTION_WEIGHT, limit),
+        ).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"Error searching the icon index for '{query}': {e}")
+        return None
+    if len(rows) < min(min_results, limit):
+        return None
+    return [
+        {
+            "id_": id_,
+            "tags": json.loads(tags),
+            "collection_names": json.loads(collection_names),
+        }
+        for id_, tags, collection_names in rows
+    ]
@@ -0,0 +1,84 @@
+"""Offline re-ranking of icon search results by similarity to the query.
+
+Queries and icons are embedded as TF-IDF weighted character n-gram vectors,
+hashed into a fixed number of dimensions, so that no model or vocabulary is
+needed and near matches ("cell" and "cells", "microscope" and "microscopy")
+still score. Icons are ranked by the cosine similarity of the query to their
+tags, and to a lesser extent their collection names.
+
+Ranking needs NumPy. Without it, results are returned in the order given.
+"""
+
+import zlib
+from collections.abc import Sequence
+from typing import TYPE_CHECKING
+
+from ..logger import logger
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - optional dependency
+    np = None
+
+if TYPE_CHECKING:
+    from .nounproject import IconSearchResult
+
+# Dimensions that n-grams are hashed into. Collisions are rare at this size for
+# the few hundred distinct n-grams in a set of search results.
+N_FEATURES = 2**14
+NGRAM_SIZES = (3, 4)
+
+# Relative weight of the similarity to tags and to collection names
+TAG_WEIGHT = 1.0
+COLLECTION_WEIGHT = 0.3
+
+
+def _features(text: str) -> list[int]:
+    """The hashed character n-grams of each word in a piece of text."""
+    features = []
+    for word in text.lower().split():
+        padded = f" {word} "
+        for n in NGRAM_SIZES:
+            for i in range(max(1, len(padded) - n + 1)):
+                # crc32 rather than hash(), which differs between processes
+                features.append(zlib.crc32(padded[i : i + n].encode()) % N_FEATURES)
+    return features
+
+
+def _vectors(texts: Sequence[str]):
+    """L2-normalized TF-IDF vectors of texts, with IDF taken across the texts."""
+    assert np is not None
+    features = [_features(text) for text in texts]
+    rows = np.repeat(np.arange(len(texts)), [len(f) for f in features])
+    # Only the hashed dimensions that occur are kept, so the matrix stays small
+    _, columns = np.unique(
+        np.fromiter((h for f in features for h in f), dtype=np.int64),
+        return_inverse=True,
+    )
+    counts = np.zeros((len(texts), columns.max(initial=-1) + 1), dtype=np.float32)
+    np.add.at(counts, (rows, columns), 1)
+    # Sublinear term frequency, so that repeated tags don't dominate
+    tf = np.log1p(counts)
+    df = np.count_nonzero(counts, axis=0)
+    idf = np.log((1 + len(texts)) / (1 + df)) + 1
+    vectors = tf * idf
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def rank(query: str, results: list["IconSearchResult"]) -> list["IconSearchResult"]:
+    """Order search results from most to least similar to the query.
+
+    Ties keep their original order.
+    """
+    if np is None or len(results) < 2 or not query.strip():
+        return results
+    tags = [" ".join(result.tags) for result in results]
+    collections = [" ".join(result.collection_names) for result in results]
+    vectors = _vectors([query, *tags, *collections])
+    similarity = vectors[1:] @ vectors[0]
+    n = len(results)
+    scores = TAG_WEIGHT * similarity[:n] + COLLECTION_WEIGHT * similarity[n:]
+    order = np.argsort(-scores, kind="stable")
+    logger.debug(f"Ranked icons for '{query}' with scores {scores[order].round(2)}")
+    return [results[i] for i in order]
@@ -0,0 +1,90 @@
+"""Locks used to coalesce concurrent computations of the same cached result."""
+
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+import redis
+from redis.exceptions import LockError
+
+from ..logger import logger
+
+
+class KeyedLocks:
+    """A set of in-process locks, one per key, that are dropped once unused."""
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks: dict[str, tuple[threading.Lock, int]] = {}
+
+    @contextmanager
+    def hold(self, key: str, timeout: float | None = None) -> Iterator[bool]:
+        """Hold the lock for a key, waiting for it for at most `timeout` seconds.
+
+        Yields whether the lock was acquired. If it wasn't, the block runs anyway.
+        """
+        with self._guard:
+            lock, n_users = self._locks.get(key, (threading.Lock(), 0))
+            self._locks[key] = (lock, n_users + 1)
+        acquired = False
+        try:
+            acquired = lock.acquire(timeout=-1 if timeout is None else max(timeout, 0))
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+            with self._guard:
+                lock, n_users = self._locks[key]
+                if n_users == 1:
+                    del self._locks[key]
+                else:
+                    self._locks[key] = (lock, n_users - 1)
+
+
+@contextmanager
+def redis_single_flight(
+    client: redis.Redis,
+    key: str,
+    timeout: float,
+    poll: Callable[[], Any],
+    miss: object,
+    max_wait: float | None = None,
+) -> Iterator[Any]:
+    """Wait until this process is the only one computing `key` across all workers.
+
+    While another process holds the lock, `poll` is called periodically. If it
+    returns anything other than `miss` (i.e. the other process stored its result),
+    that value is yielded and the caller should use it instead of computing.
+    Otherwise `miss` is yielded once the lock is held.
+
+    The lock expires after `timeout` seconds, so a holder that dies only delays
+    waiters rather than blocking them forever. Waiters that still can't get the
+    lock after that (or after `max_wait`, if it is shorter) go ahead and compute
+    anyway.
+    """
+    lock = client.lock(f"{key}-lock", timeout=timeout)
+    wait = timeout if max_wait is None else min(timeout, max_wait)
+    deadline = time.monotonic() + wait
+    delay = 0.05
+    while not lock.acquire(blocking=False):
+        value = poll()
+        if value is not miss:
+            yield value
+            return
+        if time.monotonic() > deadline:
+            logger.warning(f"Timed out waiting for lock on {key}. Computing anyway.")
+            yield miss
+            return
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+    try:
+        # The previous holder may have stored a result just before releasing
+        yield poll()
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning(f"Lock on {key} expired before the computation finished")
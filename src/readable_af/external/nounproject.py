@@ -1,18 +1,23 @@
 from base64 import b64decode
 import copy
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from pydantic import BaseModel, Field
-import requests
-from requests_oauthlib import OAuth1
-
 from ..config import Config
+from ..errors import AFException
 from ..logger import logger
+from . import blobs, http, icon_index, rate_limit, resilience
 from .caching import cache_af
 
 from openai.types.responses import FunctionToolParam
 
 
+class SearchFailed(AFException):
+    """Raised when the API answers a search without any results, even empty ones."""
+
+
 class IconSearchResult(BaseModel):
     id_: str = Field(description="ID for the icon on nounproject")
     tags: list[str] = Field(description="A list of tags associated with this icon")
@@ -42,18 +47,119 @@ SEARCH_TOOL = FunctionToolParam(
 )
 
 
+# Icon search results change slowly, but do change, so they are refreshed weekly.
+# Older results are still served (while refreshing in the background) for a month.
+SEARCH_CACHE_TTL = 7 * 24 * 60 * 60
+SEARCH_CACHE_STALE_TTL = 30 * 24 * 60 * 60
+
+
+# Seconds to wait for an icon download. Another icon can be used instead of a slow one.
+DOWNLOAD_TIMEOUT = 10
+
+
+# Searches are answered from the local icon index when it has at least this many
+# icons matching every term of the query (or `limit`, if that's fewer)
+MIN_LOCAL_RESULTS = 10
+ENRICH_WORKERS = 2
+
+_enrich_pool = ThreadPoolExecutor(max_workers=ENRICH_WORKERS)
+_enriching: set[str] = set()
+_enriching_lock = threading.Lock()
+
+
+def _auth():
+    cfg = Config.get()
+    return http.oauth1(cfg.nounproject_api_key, cfg.nounproject_secret)
+
+
+def _get(endpoint: str, **kwargs):
+    """Send a request to the API once the rate limit allows.
+
+    The request times out by the current deadline, if there is one.
+    """
+    rate_limit.acquire("nounproject", Config.get().nounproject_api_key)
+    left = resilience.remaining()
+    if left is not None:
+        if left <= 0:
+            raise resilience.DeadlineExceeded(
+                f"Ran out of time before calling {endpoint}"
+            )
+        connect, read = kwargs.get("timeout", (http.CONNECT_TIMEOUT, http.READ_TIMEOUT))
+        kwargs["timeout"] = (min(connect, left), min(read, left))
+    return http.get(endpoint, auth=_auth(), **kwargs)
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a search query so that trivially different queries share results"""
+    return " ".join(query.lower().split())
+
+
 def search(query: str, limit: int = 20) -> list[IconSearchResult]:
     """Search for nounproject icons matching a query
 
+    Results are served from the cache of API results if possible, then from the
+    local icon index if it has enough matches (fetching results from the API in
+    the background, to improve the index), and only then from the API.
+
     :param query: The keyword(s) with which to query nounproject
     :param limit: The maximum number of icons to return
     """
-    auth = OAuth1(Config.get().nounproject_api_key, Config.get().nounproject_secret)
-    endpoint = "https://api.thenounproject.com/v2/icon"
+    query = normalize_query(query)
+    [cached] = _search.get_many(
+        [{"query": query, "limit": limit}], compute_missing=False
+    )
+    if cached is not None:
+        return cached
+    local = icon_index.search(query, limit, min_results=MIN_LOCAL_RESULTS)
+    if local is None:
+        try:
+            return _search(query, limit)
+        except SearchFailed as e:
+            logger.warning(e)
+            return []
+    logger.debug(f"Found {len(local)} icons for '{query}' in the local index")
+    if not icon_index.searched(query):
+        _enrich(query, limit)
+    return [IconSearchResult(**result) for result in local]
+
+
+def _enrich(query: str, limit: int):
+    """Search the API in the background, adding the results to the index."""
+    with _enriching_lock:
+        if query in _enriching:
+            return
+        _enriching.add(query)
+
+    def enrich():
+        try:
+            _search(query, limit)
+        except Exception as e:
+            logger.warning(f"Error adding results for '{query}' to the index: {e}")
+        finally:
+            with _enriching_lock:
+                _enriching.discard(query)
+
+    _enrich_pool.submit(enrich)
+
+
+@cache_af(
+    version="1",
+    key_fn=lambda query, limit=20: (normalize_query(query), limit),
+    ttl=SEARCH_CACHE_TTL,
+    stale_ttl=SEARCH_CACHE_STALE_TTL,
+    # Where results were cached when this was the public `search`
+    namespace="search",
+)
+def _search(query: str, limit: int = 20) -> list[IconSearchResult]:
+    """Search the nounproject API, adding the results to the local index.
+
+    :raises SearchFailed: If the response has no results, so that it isn't cached
+    """
+    query = normalize_query(query)
+    endpoint = f"{Config.get().nounproject_base_url}/v2/icon"
 
-    response = requests.get(
+    response = _get(
         endpoint,
-        auth=auth,
         params={
             "query": query,
             "limit_to_public_domain": 0,
@@ -63,8 +169,8 @@ def search(query: str, limit: int = 20) -> list[IconSearchResult]:
     )
     content = json.loads(response.content.decode("utf-8"))
     if "icons" not in content:
-        return []
-    return [
+        raise SearchFailed(f"No results in the response to the search '{query}'")
+    results = [
         IconSearchResult(
             id_=icon["id"],
             tags=icon["tags"],
@@ -72,6 +178,8 @@ def search(query: str, limit: int = 20) -> list[IconSearchResult]:
         )
         for icon in content["icons"]
     ]
+    icon_index.add(query, [result.model_dump() for result in results])
+    return results
 
 
 @cache_af(version="2")
@@ -81,12 +189,10 @@ def _find_icon_ids(query: str) -> list[int]:
     :param query: A term to search for in nounproject
     :returns: A list of IDs for icons that match the query
     """
-    auth = OAuth1(Config.get().nounproject_api_key, Config.get().nounproject_secret)
-    endpoint = "https://api.thenounproject.com/v2/icon"
+    endpoint = f"{Config.get().nounproject_base_url}/v2/icon"
 
-    response = requests.get(
+    response = _get(
         endpoint,
-        auth=auth,
         params={"query": query, "limit_to_public_domain": 0, "include_svg": 0},
     )
     content = json.loads(response.content.decode("utf-8"))
@@ -97,14 +203,28 @@ def _find_icon_ids(query: str) -> list[int]:
     return ids
 
 
-@cache_af(version="2", verify_fn=lambda x: x is not None)
-def get_icon(icon_id: int) -> bytes | None:
+@cache_af(
+    version="1",
+    verify_fn=lambda digest: digest is not None and blobs.exists(digest),
+    single_flight=True,
+)
+def get_icon_hash(icon_id: int) -> str | None:
+    """Download an icon into the blob store, returning the hash of its image.
+
+    Only the hash is cached, so icons that share an image share its storage.
+    An icon whose image is no longer in the store is downloaded again.
+    """
+    contents = _download_icon(icon_id)
+    return None if contents is None else blobs.put(contents)
+
+
+def _download_icon(icon_id: int) -> bytes | None:
     """Given an icon URL, get the icon itself"""
-    cfg = Config.get()
-    auth = OAuth1(cfg.nounproject_api_key, cfg.nounproject_secret)
-    endpoint = f"https://api.thenounproject.com/v2/icon/{icon_id}/download"
-    response = requests.get(
-        endpoint, auth=auth, params={"color": "000000", "filetype": "png", "size": 100}
+    endpoint = f"{Config.get().nounproject_base_url}/v2/icon/{icon_id}/download"
+    response = _get(
+        endpoint,
+        params={"color": "000000", "filetype": "png", "size": 100},
+        timeout=(http.CONNECT_TIMEOUT, DOWNLOAD_TIMEOUT),
     )
     try:
         content = json.loads(response.content.decode("utf-8"))
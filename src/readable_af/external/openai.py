@@ -1,22 +1,34 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from functools import cache
-from typing import Literal, TypeVar, Type
+from typing import Any, Callable, Literal, TypeVar, Type
 
-from openai import OpenAI
+from openai import BadRequestError, NotFoundError, OpenAI
 from openai.types.chat import ChatCompletion
+from openai.types.responses import FunctionToolParam
 
 from ..config import Config
 from ..logger import logger
 from .caching import cache_af
-from . import nounproject
+from . import icon_ranking, nounproject, resilience, tokens
 
 T = TypeVar("T", bound=BaseModel)
 
+# Called with the kind of an event and its data as a structured completion progresses
+OnEvent = Callable[[str, dict[str, Any]], None]
+# Called with the query and tool output of each search made on the model's behalf
+OnSearch = Callable[[str, str], None]
+
 
 @cache
 def client():
-    return OpenAI(api_key=Config.get().openai_api_key)
+    # Retries and timeouts are handled by `resilience.call` instead
+    cfg = Config.get()
+    return OpenAI(
+        api_key=cfg.openai_api_key, base_url=cfg.openai_base_url, max_retries=0
+    )
 
 
 class Message(BaseModel):
@@ -24,20 +36,29 @@ class Message(BaseModel):
     role: Literal["user", "assistant", "system"] = "user"
 
 
-@cache_af()
+@cache_af(single_flight=True)
 def _completion_api(messages: list[dict], model="gpt-4-1106-preview") -> ChatCompletion:
     """Send a completion request to the OpenAI API."""
-    print(len(json.dumps(messages)))
-    if len(json.dumps(messages)) > 16384:
-        raise ValueError("Hit arbitrary length limit! Messages must be less than 16kb")
-    logger.debug(
-        "Sending the following prompt: \n"
-        + "\n"
-        + json.dumps(messages, indent=2)
-        + "\n"
-    )
+    n_tokens = tokens.check(messages, model)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            f"Sending the following {n_tokens} token prompt: \n"
+            + "\n"
+            + json.dumps(messages, indent=2)
+            + "\n"
+        )
     # Idk what type this actually is should be so I'm ignoring it and pretending its a dict
-    return client().chat.completions.create(model=model, messages=messages)  # type: ignore
+    response = resilience.call(
+        "chat.completions.create",
+        client().chat.completions.create,
+        model=model,
+        messages=messages,  # type: ignore
+    )
+    if response.usage is not None:
+        tokens.record_usage(
+            model, response.usage.prompt_tokens, response.usage.completion_tokens
+        )
+    return response
 
 
 def completion(messages: list[Message], model: str = "gpt-4-1106-preview") -> str:
@@ -48,37 +69,126 @@ def completion(messages: list[Message], model: str = "gpt-4-1106-preview") -> st
     assert str_response is not None
     return str_response
 
+
 # The maximum number of times that openai can ask us to use a function on its behalf
-MAX_FUNCTION_CALLING_ITERATIONS=20
+MAX_FUNCTION_CALLING_ITERATIONS = 20
 
-def completion_structured(
-    messages: list[Message], response_model: Type[T], model: str = "gpt-4o-2024-08-06"
-) -> T:
-    """Send a completion request with structured output.
+# Bump to invalidate cached structured completions, e.g. when the tools change behavior
+STRUCTURED_CACHE_VERSION = "1"
 
-    Args:
-        messages: List of messages to send to the API
-        response_model: Pydantic model class that defines the expected response structure
-        model: Model to use (must support structured output, e.g. gpt-4o-2024-08-06)
+# How many of the function calls from a single model turn are run at once
+TOOL_CALL_WORKERS = 8
 
-    Returns:
-        An instance of response_model validated against the structured output
+# Continue tool-calling loops from the previous response on the API's side, sending
+# only the new function outputs, rather than resending the whole conversation
+INCREMENTAL_TOOL_CALLS = True
 
-    Raises:
-        ValueError: If the response cannot be parsed or validated
+
+class ToolCall(BaseModel):
+    """A function call made on the model's behalf during a structured completion."""
+
+    name: str
+    arguments: dict[str, Any]
+    output: str
+
+
+class StructuredRun(BaseModel):
+    """The outcome of a structured completion, along with how it was reached."""
+
+    output: dict[str, Any]
+    tool_calls: list[ToolCall] = Field(default_factory=list)
+    iterations: int = 0
+
+
+def run_search(**arguments) -> str:
+    """Search nounproject on the model's behalf, returning the tool output.
+
+    Results are ordered by their similarity to the query, best first.
     """
+    rtn = icon_ranking.rank(arguments["query"], nounproject.search(**arguments))
+    logger.info(f"searched nounproject with arguments {arguments} with response {rtn}")
+    return json.dumps([r.model_dump() for r in rtn])
 
-    logger.debug(f"Using structured output with model: {response_model.__name__}")
 
-    message_dicts = [message.model_dump() for message in messages]
+def search_output_ids(output: str) -> list[int]:
+    """The IDs of the icons in the output of `run_search`, best first."""
+    try:
+        return [int(result["id_"]) for result in json.loads(output)]
+    except (ValueError, TypeError, KeyError):
+        logger.warning(f"Could not read icon IDs from search output: {output[:200]}")
+        return []
+
+
+def _respond(on_event: OnEvent | None, **kwargs):
+    """Request a structured response, streaming its output text to `on_event`."""
+    if on_event is None:
+        response = resilience.call(
+            "responses.parse", client().responses.parse, **kwargs
+        )
+    else:
+
+        def stream(**kwargs):
+            # Retries start the output over
+            on_event("turn", {})
+            with client().responses.stream(**kwargs) as stream:
+                for event in stream:
+                    if event.type == "response.output_text.delta":
+                        on_event("output_delta", {"delta": event.delta})
+                return stream.get_final_response()
+
+        # Hedging would interleave the output of both streams
+        response = resilience.call("responses.stream", stream, hedge=False, **kwargs)
+    if response.usage is not None:
+        tokens.record_usage(
+            kwargs["model"], response.usage.input_tokens, response.usage.output_tokens
+        )
+    return response
 
+
+def _structured_run_key(
+    message_dicts: list[dict],
+    response_model: type[BaseModel],
+    model: str,
+    tools: list[FunctionToolParam],
+    on_event: OnEvent | None = None,
+    on_search: OnSearch | None = None,
+):
+    return (message_dicts, response_model.model_json_schema(), model, tools)
+
+
+@cache_af(
+    version=STRUCTURED_CACHE_VERSION, key_fn=_structured_run_key, single_flight=True
+)
+def _structured_run(
+    message_dicts: list[dict],
+    response_model: type[BaseModel],
+    model: str,
+    tools: list[FunctionToolParam],
+    on_event: OnEvent | None = None,
+    on_search: OnSearch | None = None,
+) -> StructuredRun:
+    """Run the structured output tool-calling loop until the model gives a response.
+
+    If `on_event` is given, responses are streamed, and it is called with:
+    a "turn" event as each response starts streaming, "search" events for each
+    search made on the model's behalf, and "output_delta" events with the output
+    text as it is generated. The output text restarts with each turn.
+
+    `on_search` is called (from a worker thread) as soon as each search finishes,
+    while the model is still choosing.
+    """
+    tokens.check(message_dicts, model)
+    message_dicts = list(message_dicts)
+    tool_calls: list[ToolCall] = []
+    # Outputs of searches made so far in this run, by normalized query
+    search_outputs: dict[str, str] = {}
     try:
-        # Call API directly with structured output (not using _completion_api to avoid modifying it)
-        response = client().responses.parse(
+        response = _respond(
+            on_event,
             model=model,
             input=json.dumps(message_dicts),
             text_format=response_model,
-            tools=[nounproject.SEARCH_TOOL],
+            tools=tools,
         )
     except Exception as e:
         logger.error(f"Failed to get structured output from OpenAI API: {e}")
@@ -87,44 +197,144 @@ def completion_structured(
     if response.error is not None:
         raise ValueError(f"OpenAI API returned an error: {response.error.message}")
 
+    incremental = INCREMENTAL_TOOL_CALLS
     response_iterations = 0
     while response.output_parsed is None:
         response_iterations += 1
         logger.info(f"looping for {response_iterations}th time")
         if response_iterations > MAX_FUNCTION_CALLING_ITERATIONS:
-            raise ValueError(f"No definitive response recieved in {MAX_FUNCTION_CALLING_ITERATIONS} iterations")
+            raise ValueError(
+                "No definitive response recieved in "
+                f"{MAX_FUNCTION_CALLING_ITERATIONS} iterations"
+            )
 
         # If any output from the response requested a function call,
         # call that function and make a subsequent request to openAI
         # with the result of calling that function
-        for item in response.output:
-            if (
-                item.type == "function_call"
-            ): 
-                if (
-                    item.name == "search_nounproject"
-                ): 
-                    arguments = json.loads(item.arguments)
-                    rtn = nounproject.search(**arguments)
-
-                    logger.info(
-                        f"searched nounproject with arguments {arguments} with response {rtn}"
-                    )
-
-                    rtn_dict = [r.model_dump() for r in rtn]
-                    message_dicts.append(
-                        {
-                            "type": "function_call_output",
-                            "call_id": item.call_id,
-                            "output": json.dumps(rtn_dict),
-                        }
-                    )
-
-        response = client().responses.parse(
+        calls = [
+            (item, json.loads(item.arguments))
+            for item in response.output
+            if item.type == "function_call" and item.name == "search_nounproject"
+        ]
+        # The model often repeats a search; only send each query once
+        pending: dict[str, dict] = {}
+        for _, arguments in calls:
+            query = nounproject.normalize_query(arguments["query"])
+            if query not in search_outputs:
+                pending.setdefault(query, arguments)
+        if pending:
+            if on_event is not None:
+                for arguments in pending.values():
+                    on_event("search", {"query": arguments["query"]})
+
+            def search(kwargs: dict) -> str:
+                output = run_search(**kwargs)
+                if on_search is not None:
+                    on_search(kwargs["query"], output)
+                return output
+
+            with ThreadPoolExecutor(
+                max_workers=min(TOOL_CALL_WORKERS, len(pending))
+            ) as pool:
+                outputs = pool.map(resilience.in_context(search), pending.values())
+                search_outputs.update(zip(pending, outputs))
+
+        new_items = []
+        for item, arguments in calls:
+            output = search_outputs[nounproject.normalize_query(arguments["query"])]
+            tool_calls.append(
+                ToolCall(name=item.name, arguments=arguments, output=output)
+            )
+            new_items.append(
+                {
+                    "type": "function_call_output",
+                    "call_id": item.call_id,
+                    "output": output,
+                }
+            )
+        message_dicts.extend(new_items)
+
+        if incremental:
+            # The API already has the conversation so far; only send what's new
+            try:
+                response = _respond(
+                    on_event,
+                    model=model,
+                    previous_response_id=response.id,
+                    input=new_items,
+                    text_format=response_model,
+                    tools=tools,
+                )
+                continue
+            except (BadRequestError, NotFoundError) as e:
+                logger.warning(
+                    "Could not continue from the previous response. "
+                    f"Resending the whole conversation: {e}"
+                )
+                incremental = False
+        response = _respond(
+            on_event,
             model=model,
             input=json.dumps(message_dicts),
             text_format=response_model,
-            tools=[nounproject.SEARCH_TOOL],
+            tools=tools,
         )
 
-    return response.output_parsed
+    return StructuredRun(
+        output=response.output_parsed.model_dump(mode="json"),
+        tool_calls=tool_calls,
+        iterations=response_iterations,
+    )
+
+
+def structured_run(
+    messages: list[Message],
+    response_model: type[BaseModel],
+    model: str,
+    on_event: OnEvent | None = None,
+    on_search: OnSearch | None = None,
+) -> StructuredRun:
+    """Run a structured completion, returning the raw output and the tool calls made.
+
+    Results are cached on the messages, model, response schema and tool definitions.
+    Cached results are returned without calling `on_event` or `on_search`.
+    """
+    logger.debug(f"Using structured output with model: {response_model.__name__}")
+    message_dicts = [message.model_dump() for message in messages]
+    run = _structured_run(
+        message_dicts,
+        response_model,
+        model,
+        [nounproject.SEARCH_TOOL],
+        on_event,
+        on_search,
+    )
+    for call in run.tool_calls:
+        logger.debug(f"Tool call {call.name}({call.arguments}) -> {call.output}")
+    return run
+
+
+def completion_structured(
+    messages: list[Message],
+    response_model: Type[T],
+    model: str = "gpt-4o-2024-08-06",
+    on_event: OnEvent | None = None,
+) -> T:
+    """Send a completion request with structured output.
+
+    Args:
+        messages: List of messages to send to the API
+        response_model: Pydantic model class that defines the expected response
+            structure
+        model: Model to use (must support structured output, e.g. gpt-4o-2024-08-06)
+        on_event: If given, the response is streamed and progress is reported to it
+            (see `_structured_run`)
+
+    Returns:
+        An instance of response_model validated against the structured output
+
+    Raises:
+        ValueError: If the response cannot be parsed or validated
+    """
+    run = structured_run(messages, response_model, model, on_event)
+    return response_model.model_validate(run.output)
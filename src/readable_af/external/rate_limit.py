@@ -0,0 +1,136 @@
+"""Token-bucket rate limits on requests to upstream APIs, shared by all workers.
+
+Each upstream API key has its own bucket, which refills at the configured rate
+and holds up to `BURST_SECONDS` worth of requests. Callers that find the bucket
+empty reserve the next free slot and wait for it, rather than sending a request
+that the upstream would reject, as long as that slot comes before their deadline.
+
+Buckets are kept in redis if it is configured, so that the limit applies across
+workers, and in this process otherwise (or if redis is unavailable).
+"""
+
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+from functools import cache
+from typing import cast
+
+import redis
+
+from ..config import Config
+from ..logger import logger
+
+# caching imports resilience, which imports this, so caching is only used by name
+from . import caching, resilience
+
+# How many seconds of requests a full bucket holds, to absorb bursts
+BURST_SECONDS = 2
+# How long callers queue for a request if there's no deadline
+MAX_WAIT = 60
+
+# Takes a token if one is free, or otherwise reserves the next token to become
+# free by letting the bucket go negative, unless that would take longer than
+# the caller can wait. Returns the milliseconds to wait, or -1 if nothing was
+# reserved.
+_RESERVE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1e6
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - updated_at) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+    if wait > max_wait then
+        return -1
+    end
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'updated_at', now)
+-- Forget the bucket once it would have refilled
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens + 1) / rate * 1000))
+return math.ceil(wait * 1000)
+"""
+
+
+@dataclass
+class _Bucket:
+    tokens: float
+    updated_at: float
+
+
+_buckets: dict[str, _Bucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def _reserve_local(key: str, rate: float, burst: float, max_wait: float) -> float:
+    """The in-process equivalent of `_RESERVE`, in seconds."""
+    now = time.monotonic()
+    with _buckets_lock:
+        bucket = _buckets.setdefault(key, _Bucket(burst, now))
+        tokens = min(burst, bucket.tokens + (now - bucket.updated_at) * rate)
+        wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+        if wait > max_wait:
+            return -1
+        bucket.tokens, bucket.updated_at = tokens - 1, now
+        return wait
+
+
+@cache
+def _script(client: redis.Redis):
+    return client.register_script(_RESERVE)
+
+
+def _reserve(key: str, rate: float, burst: float, max_wait: float) -> float:
+    client = caching.rdb()
+    if client is not None:
+        try:
+            wait_ms = cast(
+                int, _script(client)(keys=[key], args=[rate, burst, max_wait])
+            )
+            return -1 if wait_ms < 0 else wait_ms / 1000
+        except redis.RedisError as e:
+            logger.warning(f"Redis error! Rate limiting in this process only: {e}")
+    return _reserve_local(key, rate, burst, max_wait)
+
+
+def _requests_per_minute(upstream: str) -> int:
+    cfg = Config.get()
+    return {
+        "openai": cfg.openai_requests_per_minute,
+        "nounproject": cfg.nounproject_requests_per_minute,
+    }[upstream]
+
+
+def acquire(upstream: str, api_key: str):
+    """Wait for this worker's turn to send a request to an upstream API.
+
+    :param upstream: The API, which sets the rate limit
+    :param api_key: Requests made with different keys are limited separately
+    :raises DeadlineExceeded: If the request can't be sent before the current
+            deadline (see `resilience.deadline`), or within `MAX_WAIT`
+    """
+    per_minute = _requests_per_minute(upstream)
+    if per_minute <= 0:
+        return
+    rate = per_minute / 60
+    burst = max(1, rate * BURST_SECONDS)
+    left = resilience.remaining()
+    max_wait = MAX_WAIT if left is None else min(MAX_WAIT, max(left, 0))
+    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    # No colons, which would make this look like a cached result in redis
+    key = f"ratelimit-{upstream}-{key_hash}"
+
+    wait = _reserve(key, rate, burst, max_wait)
+    if wait < 0:
+        raise resilience.DeadlineExceeded(
+            f"{upstream} is at its limit of {per_minute} requests per minute, "
+            f"and no request can be sent within {max_wait:.1f}s"
+        )
+    if wait > 0:
+        logger.debug(f"Waiting {wait:.2f}s to stay within the {upstream} rate limit")
+        time.sleep(wait)
@@ -0,0 +1,206 @@
+"""Deadlines, retries and hedged requests for calls to the OpenAI API.
+
+A deadline set with `deadline()` bounds the total time spent on every call made
+within it (in the same thread, or threads started with a copy of its context).
+Each call is retried with jittered exponential backoff on rate limits, server
+errors and timeouts, honouring Retry-After, as long as the deadline allows.
+Each request waits its turn under the OpenAI rate limit (see `rate_limit`).
+"""
+
+import contextvars
+import random
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, TypeVar
+
+import openai
+
+from ..config import Config
+from ..errors import AFException
+from ..logger import logger
+from . import rate_limit
+from .cache_stats import Histogram
+
+T = TypeVar("T")
+
+# Timeout of a single request, if the deadline doesn't call for a shorter one
+REQUEST_TIMEOUT = 60
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20
+# Retry-After values above this are treated as this
+RETRY_AFTER_MAX = 60
+
+# Once a call takes longer than the p95 latency of its operation, send a duplicate
+# request and use whichever finishes first. Only enabled once the p95 is known.
+HEDGING = True
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WORKERS = 16
+
+RETRYABLE = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,  # Includes timeouts
+)
+
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "deadline", default=None
+)
+_latencies: dict[str, Histogram] = {}
+# Also guards the histograms, which calls in many threads update at once
+_latencies_lock = threading.Lock()
+_hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+
+
+class DeadlineExceeded(AFException):
+    """Raised when a call can't be completed within the current deadline."""
+
+
+@contextmanager
+def deadline(seconds: float | None) -> Iterator[None]:
+    """Limit the total time of the calls made within this block.
+
+    Nested deadlines can only shorten the current one. `None` leaves it as is.
+    """
+    if seconds is None:
+        yield
+        return
+    current = _deadline.get()
+    new = time.monotonic() + seconds
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    """Seconds left before the current deadline, or None if there is none."""
+    current = _deadline.get()
+    if current is None:
+        return None
+    return current - time.monotonic()
+
+
+def in_context(fn: Callable[..., T]) -> Callable[..., T]:
+    """Wrap `fn` to run in a copy of the current context, in whichever thread.
+
+    Worker threads don't inherit the context of the code that hands them work,
+    so functions passed to them should be wrapped with this to stay within the
+    current deadline.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs) -> T:
+        # A context can't be entered by two threads at once, so each call
+        # gets its own copy
+        return context.copy().run(fn, *args, **kwargs)
+
+    return run
+
+
+def _timeout(operation: str) -> float:
+    """The timeout of the next request, which must end before the deadline."""
+    left = remaining()
+    if left is None:
+        return REQUEST_TIMEOUT
+    if left <= 0:
+        raise DeadlineExceeded(f"Ran out of time before calling {operation}")
+    return min(REQUEST_TIMEOUT, left)
+
+
+def _retry_after(e: Exception) -> float | None:
+    """How long the server asked us to wait before retrying, if it did."""
+    if not isinstance(e, openai.APIStatusError):
+        return None
+    headers = e.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def _backoff(attempt: int, e: Exception) -> float:
+    retry_after = _retry_after(e)
+    if retry_after is not None:
+        return min(max(retry_after, 0), RETRY_AFTER_MAX)
+    # Full jitter, so that clients that failed together don't retry together
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def _latency(operation: str) -> Histogram:
+    with _latencies_lock:
+        if operation not in _latencies:
+            _latencies[operation] = Histogram()
+        return _latencies[operation]
+
+
+def _acquire():
+    rate_limit.acquire("openai", Config.get().openai_api_key)
+
+
+def _hedged(operation: str, fn: Callable[..., T], threshold: float, **kwargs) -> T:
+    """Call `fn`, sending a duplicate request if the first is slower than threshold."""
+    first = _hedge_pool.submit(fn, timeout=_timeout(operation), **kwargs)
+    done, _ = wait([first], timeout=threshold)
+    if done:
+        return first.result()
+    logger.info(f"{operation} is taking longer than {threshold}s. Hedging.")
+    _acquire()
+    pending = {first, _hedge_pool.submit(fn, timeout=_timeout(operation), **kwargs)}
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            # Only give up once both requests have failed
+            if future.exception() is None or not pending:
+                return future.result()
+
+
+def call(operation: str, fn: Callable[..., T], hedge: bool = True, **kwargs: Any) -> T:
+    """Call an OpenAI client method with a timeout, retries and hedging.
+
+    :param operation: Names the call, for logging and latency tracking
+    :param fn: Called with `timeout` and `kwargs`
+    :param hedge: Whether duplicate requests may be sent. Disable for calls that
+           aren't safe to make twice at once.
+    :raises DeadlineExceeded: If the current deadline passes before a call succeeds
+    """
+    latency = _latency(operation)
+    for attempt in range(MAX_ATTEMPTS):
+        start = time.monotonic()
+        _acquire()
+        with _latencies_lock:
+            p95, n_samples = latency.quantile(0.95), latency.n
+        try:
+            if HEDGING and hedge and p95 is not None and n_samples >= HEDGE_MIN_SAMPLES:
+                result = _hedged(operation, fn, p95 / 1000, **kwargs)
+            else:
+                result = fn(timeout=_timeout(operation), **kwargs)
+        except RETRYABLE as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = _backoff(attempt, e)
+            left = remaining()
+            if left is not None and delay >= left:
+                raise DeadlineExceeded(
+                    f"Ran out of time retrying {operation} after: {e}"
+                ) from e
+            logger.warning(f"Error calling {operation}. Retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+            continue
+        with _latencies_lock:
+            latency.observe((time.monotonic() - start) * 1000)
+        return result
+    raise AssertionError("unreachable")
@@ -0,0 +1,255 @@
+"""Compact, versioned serialization of cached results.
+
+Every serialized value starts with a small header:
+
+    b"AF" | format version (1 byte) | codec (1 byte) | compression (1 byte)
+         | time the value was stored (8 byte float)
+
+followed by the (possibly compressed) encoded value. Values are encoded as
+JSON (or msgpack, if installed) with pydantic models stored as their data plus
+the path of their class, so cached entries don't depend on pickle internals of
+the models they hold. Values that can't be represented that way are pickled.
+
+Data without the header is assumed to be a legacy pickle and is unpickled.
+"""
+
+import importlib
+import json
+import pickle
+import struct
+import time
+import zlib
+from base64 import b64decode, b64encode
+from typing import Any, Protocol
+
+from pydantic import BaseModel
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+MAGIC = b"AF"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct(">2sBBBd")
+
+# Payloads smaller than this are not worth compressing
+COMPRESSION_THRESHOLD = 512
+
+
+class Codec(Protocol):
+    id: int
+
+    def encode(self, value: Any) -> bytes: ...
+
+    def decode(self, data: bytes) -> Any: ...
+
+
+class Compressor(Protocol):
+    id: int
+
+    def compress(self, data: bytes) -> bytes: ...
+
+    def decompress(self, data: bytes) -> bytes: ...
+
+
+class UnsupportedValue(TypeError):
+    """Raised by a codec that cannot represent a value."""
+
+
+def _to_tagged(value: Any, binary: bool) -> Any:
+    """Convert a value to plain containers, tagging models and (for JSON) bytes."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, bytes):
+        return value if binary else {"__bytes__": b64encode(value).decode("ascii")}
+    if isinstance(value, list):
+        return [_to_tagged(v, binary) for v in value]
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {k: _to_tagged(v, binary) for k, v in value.items()}
+    if isinstance(value, BaseModel):
+        cls = type(value)
+        return {
+            "__model__": f"{cls.__module__}:{cls.__qualname__}",
+            "data": value.model_dump(mode="json"),
+        }
+    raise UnsupportedValue(f"Cannot encode value of type {type(value)}")
+
+
+def _from_tagged(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_from_tagged(v) for v in value]
+    if isinstance(value, dict):
+        if "__bytes__" in value:
+            return b64decode(value["__bytes__"])
+        if "__model__" in value:
+            module, qualname = value["__model__"].split(":")
+            cls: Any = importlib.import_module(module)
+            for attr in qualname.split("."):
+                cls = getattr(cls, attr)
+            return cls.model_validate(value["data"])
+        return {k: _from_tagged(v) for k, v in value.items()}
+    return value
+
+
+class RawCodec:
+    """Stores bytes values as-is."""
+
+    id = 0
+
+    def encode(self, value: Any) -> bytes:
+        if not isinstance(value, bytes):
+            raise UnsupportedValue(f"Cannot encode value of type {type(value)}")
+        return value
+
+    def decode(self, data: bytes) -> Any:
+        return data
+
+
+class JsonCodec:
+    id = 1
+
+    def encode(self, value: Any) -> bytes:
+        tagged = _to_tagged(value, binary=False)
+        return json.dumps(tagged, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, data: bytes) -> Any:
+        return _from_tagged(json.loads(data))
+
+
+class MsgpackCodec:
+    id = 2
+
+    def encode(self, value: Any) -> bytes:
+        assert msgpack is not None
+        data = msgpack.packb(_to_tagged(value, binary=True))
+        assert data is not None
+        return data
+
+    def decode(self, data: bytes) -> Any:
+        assert msgpack is not None
+        return _from_tagged(msgpack.unpackb(data))
+
+
+class PickleCodec:
+    """Fallback for values the other codecs cannot represent."""
+
+    id = 3
+
+    def encode(self, value: Any) -> bytes:
+        return pickle.dumps(value)
+
+    def decode(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+
+class NoCompression:
+    id = 0
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class ZlibCompression:
+    id = 1
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, 6)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompression:
+    id = 2
+
+    def compress(self, data: bytes) -> bytes:
+        assert zstandard is not None
+        return zstandard.ZstdCompressor(level=6).compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        assert zstandard is not None
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS: dict[int, Codec] = {
+    c.id: c for c in (RawCodec(), JsonCodec(), MsgpackCodec(), PickleCodec())
+}
+COMPRESSORS: dict[int, Compressor] = {
+    c.id: c for c in (NoCompression(), ZlibCompression(), ZstdCompression())
+}
+
+
+def default_codecs() -> list[Codec]:
+    structured = MsgpackCodec() if msgpack is not None else JsonCodec()
+    return [RawCodec(), structured, PickleCodec()]
+
+
+def default_compressor() -> Compressor:
+    return ZstdCompression() if zstandard is not None else ZlibCompression()
+
+
+class Serializer:
+    """Converts cached values to and from bytes.
+
+    :param codecs: Codecs to try, in order. The first that can represent a value is
+           used to encode it. Any registered codec can decode.
+    :param compressor: Used to compress encoded values above COMPRESSION_THRESHOLD.
+    """
+
+    def __init__(
+        self,
+        codecs: list[Codec] | None = None,
+        compressor: Compressor | None = None,
+    ):
+        self.codecs = codecs if codecs is not None else default_codecs()
+        self.compressor = compressor if compressor is not None else default_compressor()
+
+    def dumps(self, value: Any) -> bytes:
+        for codec in self.codecs:
+            try:
+                encoded = codec.encode(value)
+                break
+            except UnsupportedValue:
+                continue
+        else:
+            raise UnsupportedValue(f"No codec can encode value of type {type(value)}")
+
+        compressor: Compressor = NoCompression()
+        if len(encoded) >= COMPRESSION_THRESHOLD:
+            compressed = self.compressor.compress(encoded)
+            if len(compressed) < len(encoded):
+                encoded = compressed
+                compressor = self.compressor
+
+        header = _HEADER.pack(
+            MAGIC, FORMAT_VERSION, codec.id, compressor.id, time.time()
+        )
+        return header + encoded
+
+    @staticmethod
+    def stored_at(data: bytes) -> float | None:
+        """The time a value was serialized, or None if it predates the header."""
+        if not data.startswith(MAGIC):
+            return None
+        return _HEADER.unpack_from(data)[4]
+
+    def loads(self, data: bytes) -> Any:
+        if not data.startswith(MAGIC):
+            return pickle.loads(data)
+        _, version, codec_id, compression_id, _ = _HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unknown cache format version {version}")
+        payload = COMPRESSORS[compression_id].decompress(data[_HEADER.size :])
+        return CODECS[codec_id].decode(payload)
+
+
+DEFAULT_SERIALIZER = Serializer()
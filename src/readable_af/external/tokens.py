@@ -0,0 +1,125 @@
+"""Token counting and budgets for requests to OpenAI models.
+
+Tokens are counted offline with tiktoken if it is installed and has the model's
+encoding, which it downloads on first use unless it is in TIKTOKEN_CACHE_DIR.
+Otherwise they are estimated from the length of the text, erring on the side of
+overcounting.
+"""
+
+import math
+from functools import cache
+from typing import Any
+
+from ..errors import AFException
+from ..logger import logger
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+# Used without tiktoken or its encoding. English text averages ~4 characters per token
+CHARS_PER_TOKEN = 3
+
+# Tokens added to each message by the chat format, and to prime the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# Context window and maximum output tokens of each model, by model name prefix.
+# The longest matching prefix is used.
+MODEL_LIMITS: dict[str, tuple[int, int]] = {
+    "gpt-4-1106-preview": (128_000, 4_096),
+    "gpt-4o": (128_000, 16_384),
+    "gpt-4.1": (1_047_576, 32_768),
+    "gpt-5": (400_000, 128_000),
+}
+DEFAULT_LIMITS = (128_000, 4_096)
+
+
+class TokenBudgetExceeded(AFException):
+    """Raised when a request would not fit in a model's context window."""
+
+
+def limits(model: str) -> tuple[int, int]:
+    """The context window and maximum output tokens for a model."""
+    matches = [prefix for prefix in MODEL_LIMITS if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT_LIMITS
+    return MODEL_LIMITS[max(matches, key=len)]
+
+
+@cache
+def _encoding(model: str):
+    """The encoding of a model, or None if it can't be loaded."""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # e.g. it isn't cached, and there's no network access to download it
+        logger.warning(f"Could not load the encoding of {model}. Estimating: {e}")
+        return None
+
+
+def count(text: str, model: str) -> int:
+    """Count the tokens in a piece of text."""
+    encoding = _encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_messages(messages: list[dict[str, Any]], model: str) -> int:
+    """Count the prompt tokens of a list of chat messages."""
+    n_tokens = TOKENS_PER_REPLY
+    for message in messages:
+        n_tokens += TOKENS_PER_MESSAGE
+        for value in message.values():
+            if isinstance(value, str):
+                n_tokens += count(value, model)
+    return n_tokens
+
+
+def check(messages: list[dict[str, Any]], model: str) -> int:
+    """Check that messages and a full-length reply fit in a model's context window.
+
+    :returns: The number of prompt tokens in the messages
+    :raises TokenBudgetExceeded: If they do not fit
+    """
+    n_tokens = count_messages(messages, model)
+    context, max_output = limits(model)
+    if n_tokens + max_output > context:
+        raise TokenBudgetExceeded(
+            f"Prompt of {n_tokens} tokens leaves no room for a {max_output} token "
+            f"reply in the {context} token context of {model}"
+        )
+    return n_tokens
+
+
+def trim(text: str, model: str, max_tokens: int) -> str:
+    """Trim text to at most `max_tokens` tokens, preferring to cut at a paragraph."""
+    if count(text, model) <= max_tokens:
+        return text
+    encoding = _encoding(model)
+    if encoding is None:
+        trimmed = text[: max_tokens * CHARS_PER_TOKEN]
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        trimmed = encoding.decode(tokens[:max_tokens])
+    # Don't end partway through a paragraph, unless that would drop most of the text
+    end = trimmed.rfind("\n")
+    if end > len(trimmed) // 2:
+        trimmed = trimmed[:end]
+    logger.warning(
+        f"Trimmed text from {len(text)} to {len(trimmed)} characters "
+        f"to fit in {max_tokens} tokens"
+    )
+    return trimmed
+
+
+def record_usage(model: str, input_tokens: int, output_tokens: int):
+    """Record the tokens used by a request to a model."""
+    logger.info(f"{model} used {input_tokens} input and {output_tokens} output tokens")
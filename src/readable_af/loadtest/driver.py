@@ -0,0 +1,150 @@
+"""Concurrent drivers that measure the latency and throughput of summarization."""
+
+import math
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import requests
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+from .. import api
+from ..logger import logger
+from ..model.request import Ctx
+
+TITLE = "A load test"
+AUTHORS = "A. Author, B. Author"
+ABSTRACT = (
+    "We measured how long it takes to summarize an abstract. "
+    "Summaries were made many times, at once, with fake services standing in "
+    "for the real ones."
+)
+
+
+@dataclass
+class LoadReport:
+    n_requests: int = 0
+    n_errors: int = 0
+    seconds: float = 0
+    latencies: list[float] = field(default_factory=list)
+
+    def percentile(self, p: float) -> float | None:
+        """The latency (in seconds) below which `p` percent of requests finished."""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    def format(self) -> str:
+        lines = [
+            f"Requests: {self.n_requests} ({self.n_errors} errors) "
+            f"in {self.seconds:.2f}s",
+            f"Throughput: {self.n_requests / self.seconds:.2f} requests/s",
+        ]
+        for p in (50, 95, 99):
+            latency = self.percentile(p)
+            if latency is not None:
+                lines.append(f"p{p}: {latency * 1000:.0f}ms")
+        return "\n".join(lines)
+
+
+def run(
+    request: Callable[[int], None], n_requests: int, concurrency: int
+) -> LoadReport:
+    """Make `n_requests` calls to `request`, `concurrency` at a time.
+
+    `request` is passed the index of the request, and fails by raising.
+    """
+    report = LoadReport(n_requests=n_requests)
+    lock = threading.Lock()
+
+    def timed(i: int):
+        start = time.perf_counter()
+        try:
+            request(i)
+        except Exception as e:
+            logger.warning(f"Request {i} failed: {e}")
+            with lock:
+                report.n_errors += 1
+            return
+        with lock:
+            report.latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, range(n_requests)))
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def abstract(i: int, unique: bool) -> str:
+    """The abstract of request `i`. Unique abstracts can't be served from the cache."""
+    return f"{ABSTRACT} (Request {i}.)" if unique else ABSTRACT
+
+
+def session_cookie(secret_key: str) -> str:
+    """A session cookie holding Google credentials that the fake Drive accepts."""
+    app = Flask(__name__)
+    app.secret_key = secret_key
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+    assert serializer is not None
+    return serializer.dumps(
+        {
+            "credentials": {
+                "token": "fake-token",
+                "refresh_token": None,
+                "token_uri": "https://oauth2.googleapis.com/token",
+                "client_id": "fake-client",
+                "client_secret": "fake-secret",
+                "scopes": ["https://www.googleapis.com/auth/drive.file"],
+            }
+        }
+    )
+
+
+def http_request(url: str, secret_key: str, unique: bool) -> Callable[[int], None]:
+    """Summarize through the web app at `url`.
+
+    The app must be using the fakes, and the same FLASK_SECRET_KEY.
+    """
+    cookies = {"session": session_cookie(secret_key)}
+
+    def request(i: int):
+        response = requests.post(
+            f"{url.rstrip('/')}/api/summarize",
+            data={
+                "g-recaptcha-response": "fake",
+                "title": TITLE,
+                "authors": AUTHORS,
+                "abstract": abstract(i, unique),
+            },
+            cookies=cookies,
+            timeout=300,
+        )
+        response.raise_for_status()
+        if "Summary generated!" not in response.text:
+            raise RuntimeError(f"Summarization failed: {response.text[:200]}")
+
+    return request
+
+
+def pipeline_request(formats: list[str], unique: bool) -> Callable[[int], None]:
+    """Summarize in this process, as the CLI does."""
+
+    def request(i: int):
+        with tempfile.TemporaryDirectory() as out:
+            for format in formats:
+                ctx = Ctx()
+                ctx.input.title = TITLE
+                ctx.input.authors = AUTHORS
+                ctx.input.abstract = abstract(i, unique)
+                ctx.output_format = format
+                ctx.output_file = Path(out) / f"summary.{format}"
+                api.summarize(ctx)
+
+    return request
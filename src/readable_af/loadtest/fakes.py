@@ -0,0 +1,387 @@
+"""Local stand-ins for the services the app depends on.
+
+A single server mimics the parts of each API that are used, under a prefix per
+service:
+
+- /openai/v1: responses (with a function-call turn before the final output,
+  streamed or not), chat completions, and the files and batches endpoints
+- /nounproject: icon search and download
+- /google: Drive folder listing, creation and upload, and reCAPTCHA verification
+
+Each service waits for a latency drawn from a configurable distribution before
+responding.
+"""
+
+import base64
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from typing import Any
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import BaseWSGIServer, make_server
+
+SERVICES = ("openai", "nounproject", "drive", "recaptcha", "batch")
+
+# A 1x1 transparent png
+ICON_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAA"
+    "AABJRU5ErkJggg=="
+)
+
+
+@dataclass
+class Latency:
+    """A log-normal latency distribution, given by its median and 95th percentile."""
+
+    median_ms: float = 0
+    p95_ms: float | None = None
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        """Parse `MEDIAN_MS[:P95_MS]`"""
+        median, _, p95 = spec.partition(":")
+        return cls(float(median), float(p95) if p95 else None)
+
+    def sample(self) -> float:
+        """A latency in seconds."""
+        if self.median_ms <= 0:
+            return 0
+        if self.p95_ms is None or self.p95_ms <= self.median_ms:
+            return self.median_ms / 1000
+        sigma = math.log(self.p95_ms / self.median_ms) / 1.645
+        return random.lognormvariate(math.log(self.median_ms), sigma) / 1000
+
+    def wait(self):
+        time.sleep(self.sample())
+
+
+@dataclass
+class FakeServices:
+    """Configuration and state of the fake services.
+
+    :param latencies: Latency of each of SERVICES. Unlisted services respond at once.
+    :param n_searches: Icon searches the fake model makes before answering
+    :param n_bullets: Bullets in the fake model's summaries
+    """
+
+    latencies: dict[str, Latency] = field(default_factory=dict)
+    n_searches: int = 10
+    n_bullets: int = 5
+    _ids: Iterator[int] = field(default_factory=itertools.count)
+    _files: dict[str, str] = field(default_factory=dict)
+    _batches: dict[str, dict[str, Any]] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def wait(self, service: str):
+        self.latencies.get(service, Latency()).wait()
+
+    def next_id(self, prefix: str) -> str:
+        with self._lock:
+            return f"{prefix}-{next(self._ids)}"
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "metadata": {
+                "title": "A fake summary",
+                "authors": ["A. Author"],
+                "date": "",
+                "simplified_title": "A fake summary",
+            },
+            "rating": "N/A",
+            "bullets": [
+                {
+                    "text": f"This is <b>bullet {i}</b> of the summary.",
+                    "icons": [
+                        {"keyword": f"icon {i}-{j}", "id": 1000 + 10 * i + j}
+                        for j in range(3)
+                    ],
+                }
+                for i in range(self.n_bullets)
+            ],
+        }
+
+    def response_output(self, input: Any) -> list[dict[str, Any]]:
+        """The output of the fake model: one round of searches, then an answer."""
+        if "function_call_output" in json.dumps(input):
+            return [
+                {
+                    "type": "message",
+                    "id": self.next_id("msg"),
+                    "role": "assistant",
+                    "status": "completed",
+                    "content": [
+                        {
+                            "type": "output_text",
+                            "text": json.dumps(self.summary()),
+                            "annotations": [],
+                        }
+                    ],
+                }
+            ]
+        return [
+            {
+                "type": "function_call",
+                "id": self.next_id("fc"),
+                "call_id": self.next_id("call"),
+                "name": "search_nounproject",
+                "arguments": json.dumps({"query": f"concept {i}"}),
+                "status": "completed",
+            }
+            for i in range(self.n_searches)
+        ]
+
+    def response(self, body: dict[str, Any]) -> dict[str, Any]:
+        output = self.response_output(body["input"])
+        return {
+            "id": self.next_id("resp"),
+            "object": "response",
+            "created_at": time.time(),
+            "model": body["model"],
+            "status": "completed",
+            "output": output,
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": body.get("tools", []),
+            "error": None,
+            "incomplete_details": None,
+            "usage": {
+                "input_tokens": len(json.dumps(body["input"])) // 4,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": len(json.dumps(output)) // 4,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": 0,
+            },
+        }
+
+    def stream_response(self, response: dict[str, Any]) -> Iterator[str]:
+        """Server-sent events for a response, as the streaming API sends them."""
+        sequence = itertools.count()
+
+        def event(type: str, **data) -> str:
+            data = {"type": type, "sequence_number": next(sequence), **data}
+            return f"event: {type}\ndata: {json.dumps(data)}\n\n"
+
+        yield event("response.created", response={**response, "output": []})
+        for index, item in enumerate(response["output"]):
+            if item["type"] != "message":
+                yield event("response.output_item.added", output_index=index, item=item)
+                yield event("response.output_item.done", output_index=index, item=item)
+                continue
+            text = item["content"][0]["text"]
+            yield event(
+                "response.output_item.added",
+                output_index=index,
+                item={**item, "content": [], "status": "in_progress"},
+            )
+            yield event(
+                "response.content_part.added",
+                output_index=index,
+                item_id=item["id"],
+                content_index=0,
+                part={"type": "output_text", "text": "", "annotations": []},
+            )
+            for start in range(0, len(text), 64):
+                yield event(
+                    "response.output_text.delta",
+                    output_index=index,
+                    item_id=item["id"],
+                    content_index=0,
+                    delta=text[start : start + 64],
+                    logprobs=[],
+                )
+            yield event(
+                "response.output_text.done",
+                output_index=index,
+                item_id=item["id"],
+                content_index=0,
+                text=text,
+                logprobs=[],
+            )
+            yield event("response.output_item.done", output_index=index, item=item)
+        yield event("response.completed", response=response)
+
+    def app(self) -> Flask:
+        app = Flask(__name__)
+
+        @app.post("/openai/v1/responses")
+        def responses():
+            body = request.get_json()
+            self.wait("openai")
+            response = self.response(body)
+            if body.get("stream"):
+                return Response(
+                    self.stream_response(response), mimetype="text/event-stream"
+                )
+            return jsonify(response)
+
+        @app.post("/openai/v1/chat/completions")
+        def chat_completions():
+            body = request.get_json()
+            self.wait("openai")
+            return jsonify(
+                {
+                    "id": self.next_id("chatcmpl"),
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {
+                                "role": "assistant",
+                                "content": "A fake title\nA. Author\n2024",
+                            },
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": len(json.dumps(body["messages"])) // 4,
+                        "completion_tokens": 10,
+                        "total_tokens": 0,
+                    },
+                }
+            )
+
+        @app.post("/openai/v1/files")
+        def create_file():
+            file_id = self.next_id("file")
+            self._files[file_id] = request.files["file"].read().decode("utf-8")
+            return jsonify(
+                {
+                    "id": file_id,
+                    "object": "file",
+                    "bytes": len(self._files[file_id]),
+                    "created_at": int(time.time()),
+                    "filename": request.files["file"].filename,
+                    "purpose": request.form["purpose"],
+                    "status": "processed",
+                }
+            )
+
+        @app.get("/openai/v1/files/<file_id>/content")
+        def file_content(file_id: str):
+            return Response(self._files[file_id], mimetype="application/jsonl")
+
+        def batch_json(batch: dict[str, Any]) -> dict[str, Any]:
+            done = time.time() >= batch["done_at"]
+            return {
+                **{k: v for k, v in batch.items() if k not in ("done_at", "output")},
+                "status": "completed" if done else "in_progress",
+                "output_file_id": batch["output"] if done else None,
+            }
+
+        @app.post("/openai/v1/batches")
+        def create_batch():
+            body = request.get_json()
+            lines = []
+            for line in self._files[body["input_file_id"]].splitlines():
+                req = json.loads(line)
+                lines.append(
+                    {
+                        "id": self.next_id("batch_req"),
+                        "custom_id": req["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "body": self.response(req["body"]),
+                        },
+                        "error": None,
+                    }
+                )
+            output = self.next_id("file")
+            self._files[output] = "\n".join(json.dumps(line) for line in lines)
+            batch_id = self.next_id("batch")
+            self._batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "created_at": int(time.time()),
+                "done_at": time.time()
+                + self.latencies.get("batch", Latency()).sample(),
+                "output": output,
+            }
+            return jsonify(batch_json(self._batches[batch_id]))
+
+        @app.get("/openai/v1/batches/<batch_id>")
+        def retrieve_batch(batch_id: str):
+            return jsonify(batch_json(self._batches[batch_id]))
+
+        @app.get("/nounproject/v2/icon")
+        def search_icons():
+            self.wait("nounproject")
+            limit = int(request.args.get("limit", 20))
+            return jsonify(
+                {
+                    "icons": [
+                        {
+                            "id": str(1000 + i),
+                            "tags": [request.args["query"]],
+                            "collections": [{"name": "Fakes"}],
+                        }
+                        for i in range(limit)
+                    ]
+                }
+            )
+
+        @app.get("/nounproject/v2/icon/<int:icon_id>/download")
+        def download_icon(icon_id: int):
+            self.wait("nounproject")
+            return jsonify(
+                {"base64_encoded_file": base64.b64encode(ICON_PNG).decode("ascii")}
+            )
+
+        @app.get("/google/drive/v3/files")
+        def list_files():
+            self.wait("drive")
+            return jsonify({"files": [{"id": "fake-folder"}]})
+
+        @app.post("/google/drive/v3/files")
+        @app.post("/google/upload/drive/v3/files")
+        def create_drive_file():
+            self.wait("drive")
+            return jsonify({"id": self.next_id("doc")})
+
+        @app.post("/google/recaptcha/siteverify")
+        def verify_recaptcha():
+            self.wait("recaptcha")
+            return jsonify({"success": True})
+
+        return app
+
+    def env(self, url: str, cache_dir: str) -> dict[str, str]:
+        """Environment variables that point the app at fakes served from `url`.
+
+        Fake credentials are used, and results are cached in `cache_dir` rather
+        than redis, so that fake results never end up in the real cache.
+        """
+        return {
+            "OPENAI_API_KEY": "fake",
+            "NOUNPROJECT_API_KEY": "fake",
+            "NOUNPROJECT_SECRET": "fake",
+            "RECAPTCHA_SITE_KEY": "fake",
+            "RECAPTCHA_SECRET": "fake",
+            "REDIS_URL": "",
+            "CACHE_DIR": cache_dir,
+            "OPENAI_BASE_URL": f"{url}/openai/v1",
+            "NOUNPROJECT_BASE_URL": f"{url}/nounproject",
+            "GOOGLE_API_ROOT_URL": f"{url}/google/",
+            "RECAPTCHA_VERIFY_URL": f"{url}/google/recaptcha/siteverify",
+        }
+
+    def serve(
+        self, host: str = "127.0.0.1", port: int = 0, log_requests: bool = False
+    ) -> BaseWSGIServer:
+        """Serve the fakes from a background thread. Port 0 picks a free port."""
+        if not log_requests:
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        server = make_server(host, port, self.app(), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -29,3 +29,6 @@ class Ctx(BaseModel):
     output_dir: Path | None = None
     output_file: Path | None = None
     output_link: str | None = None
+    # If set, the most time in seconds to spend on this request: generating the
+    # summary, downloading its icons and creating the output
+    latency_budget: float | None = None
@@ -1,6 +1,7 @@
 from pydantic import BaseModel, Field
 from pathlib import Path
 from typing import Any, TypeGuard, TypeVar, ClassVar
+from ..external import blobs
 from ..logger import logger
 
 T = TypeVar("T")
@@ -16,7 +17,10 @@ class Icon(BaseModel):
     keyword: str = Field(
         description="A keyword for the icon, typically 1-3 words that represent the concept"
     )
-    _icon: bytes | None = None
+    # Hash of the icon's image in the blob store
+    _hash: str | None = None
+    # Other icons found by the same search, to use if this one can't be downloaded
+    _alternates: list[int] = []
     id: int = Field(description="The id for this icon on NounProject")
 
     def calculate_checksum(self) -> int:
@@ -24,15 +28,31 @@ class Icon(BaseModel):
 
     @property
     def icon(self) -> bytes:
-        if not self.up_to_date(self._icon):
+        return blobs.get(self.hash)
+
+    @property
+    def hash(self) -> str:
+        if not self.up_to_date(self._hash):
             raise UnpopulatedException("Icon not populated")
-        return self._icon
+        return self._hash
+
+    @property
+    def data_uri(self) -> str:
+        return blobs.data_uri(self.hash)
 
     def __repr__(self):
         return f"Icon<{self.keyword}:{self.id}>"
 
-    def populate(self, icon: bytes):
-        self._icon = icon
+    def populate(self, digest: str):
+        """Set the icon's image, by its hash in the blob store"""
+        self._hash = digest
+
+    @property
+    def alternates(self) -> list[int]:
+        return self._alternates
+
+    def set_alternates(self, alternates: list[int]):
+        self._alternates = alternates
 
     UNSET: ClassVar[object] = object()
 
@@ -41,7 +61,7 @@ class Icon(BaseModel):
 
         :param field: (optional) A specific field to verify as non-null
         ÷"""
-        if field is Icon.UNSET and self._icon is None:
+        if field is Icon.UNSET and self._hash is None:
             return False
         elif field is None:
             return False
@@ -53,9 +73,8 @@ class Icon(BaseModel):
         return f"{self.keyword.replace(' ', '')}-{self.id}.png"
 
     def write(self, out_dir: Path):
-        """Save the icon to the filesystem"""
-        icon_path = out_dir / self.filename
-        icon_path.write_bytes(self.icon)
+        """Save the icon to the filesystem, as a link to the blob store if possible"""
+        blobs.link(self.hash, out_dir / self.filename)
 
     def asdict(self) -> dict[str, Any]:
         return {
@@ -1,12 +1,17 @@
+import json
 from typing import Any
 
 from ..model.request import Ctx
 from ..logger import logger
 from ..config import Config
+from ..external import resilience
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 import flask
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 
 
 from .html import HtmlGenerator
@@ -55,8 +60,39 @@ def get_oauth_flow(state: Any = None) -> Flow:
     return f
 
 
+def _authorization(credentials) -> dict[str, Any]:
+    """Arguments to authorize the Drive client with, timing out by the deadline."""
+    left = resilience.remaining()
+    if left is None:
+        return {"credentials": credentials}
+    if left <= 0:
+        raise resilience.DeadlineExceeded(
+            "Ran out of time before creating the document"
+        )
+    return {"http": AuthorizedHttp(credentials, http=httplib2.Http(timeout=left))}
+
+
 def authenticate(credentials):
-    return build("drive", "v3", credentials=credentials)
+    auth = _authorization(credentials)
+    root_url = Config.get().google_api_root_url
+    if root_url is None:
+        return build("drive", "v3", **auth)
+    # Uploads don't go through the API endpoint client option, so the whole
+    # service is pointed at the other server
+    static_doc = discovery_cache.get_static_doc("drive", "v3")
+    if static_doc is None:
+        # Without the document, only non-upload requests can be redirected
+        logger.warning(f"No discovery document for Drive v3. Uploads ignore {root_url}")
+        return build(
+            "drive",
+            "v3",
+            client_options={"api_endpoint": root_url},
+            **auth,
+        )
+    doc = json.loads(static_doc)
+    doc["rootUrl"] = root_url
+    doc["baseUrl"] = root_url + doc["servicePath"]
+    return build_from_document(doc, **auth)
 
 
 _FOLDER_MIMETYPE = "application/vnd.google-apps.folder"
@@ -1,4 +1,3 @@
-from base64 import b64encode
 import re
 from ..model.request import Ctx
 
@@ -63,7 +62,7 @@ class HtmlGenerator:
             text += f"<h3 class='bullet' style='text-align:center'>{bullet.text.strip()}</h3>\n"
             text += "<div class='icons' style='text-align:center'>\n"
             for icon in bullet.icons[:2]:
-                text += f"<img alt='{icon.keyword}' width=75  height=75 src='data:image/png;base64,{b64encode(icon.icon).decode('utf-8')}'/>"
+                text += f"<img alt='{icon.keyword}' width=75  height=75 src='{icon.data_uri}'/>"
             text += "</div>\n"
         text += "</body></html>"
         return text
@@ -0,0 +1,388 @@
+"""Bulk summarization of many inputs through the OpenAI Batch API.
+
+The tool-calling loop is run in rounds: each round submits one batch holding the
+next request for every unfinished input, waits for it, and runs the searches the
+model asked for locally. Inputs whose response is final are then post-processed
+as usual (icons, then each output format).
+
+Progress is kept in a manifest file, so an interrupted run picks up where it
+left off: batches that were already submitted are waited on rather than sent
+again, and finished inputs are skipped.
+"""
+
+import io
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Literal
+
+from pydantic import BaseModel, Field
+
+from ..errors import AFException
+from ..external import nounproject, resilience, tokens
+from ..external import openai as oa
+from ..logger import logger
+from ..model.request import Ctx
+from ..model.summary import Summary
+from ..output import get_generator
+from . import generation, summarization
+
+# Batch statuses after which the batch will not change
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# How many times an input is sent again if a batch completes without its result
+MAX_RESUBMISSIONS = 2
+
+
+class BatchEntry(BaseModel):
+    """The progress of a single input through the batch."""
+
+    file: Path
+    status: Literal["pending", "submitted", "generated", "done", "failed"] = "pending"
+    # The conversation so far, resent in full with each round
+    input: list[dict[str, Any]] = Field(default_factory=list)
+    tool_calls: list[oa.ToolCall] = Field(default_factory=list)
+    rounds: int = 0
+    resubmissions: int = 0
+    summary: Summary | None = None
+    error: str | None = None
+
+
+class BatchJob(BaseModel):
+    """A batch submitted to the API."""
+
+    id: str
+    entries: list[str]
+    status: str = "validating"
+    processed: bool = False
+
+
+class Manifest(BaseModel):
+    model: str
+    entries: dict[str, BatchEntry] = Field(default_factory=dict)
+    jobs: list[BatchJob] = Field(default_factory=list)
+
+    @classmethod
+    def load(cls, path: Path, model: str) -> "Manifest":
+        if not path.exists():
+            return cls(model=model)
+        return cls.model_validate_json(path.read_text())
+
+    def save(self, path: Path):
+        """Atomically write the manifest, so a crash never leaves it half-written."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.model_dump_json(indent=2))
+        os.replace(tmp, path)
+
+
+def add_inputs(manifest: Manifest, files: list[Path], retry_failed: bool = False):
+    """Add inputs that aren't in the manifest yet, skipping empty files.
+
+    :param retry_failed: Start inputs that failed in a previous run over
+    :raises AFException: If two different inputs have the same name
+    """
+    # Inputs are named by their stem, both in the manifest and in the output
+    # directory, so two files with the same stem would overwrite each other
+    paths = {name: entry.file.resolve() for name, entry in manifest.entries.items()}
+    for file in files:
+        path = paths.setdefault(file.stem, file.resolve())
+        if path != file.resolve():
+            raise AFException(
+                f"{file} and {path} would both be summarized as {file.stem!r}."
+                " Rename one of them, or summarize them into separate output directories."
+            )
+
+    for file in files:
+        entry = manifest.entries.get(file.stem)
+        if entry is not None and not (retry_failed and entry.status == "failed"):
+            continue
+        if file.stat().st_size == 0:
+            logger.warning(f"File {file} is empty. Skipping")
+            continue
+        ctx = Ctx()
+        ctx.input.file = file
+        _, abstract = summarization.read_input(ctx)
+        prompt = generation.summary_prompt(abstract)
+        message_dicts = [message.model_dump() for message in prompt]
+        entry = BatchEntry(file=file, input=message_dicts)
+        try:
+            tokens.check(message_dicts, manifest.model)
+        except tokens.TokenBudgetExceeded as e:
+            logger.warning(f"Not summarizing {file}: {e}")
+            entry.status = "failed"
+            entry.error = str(e)
+        manifest.entries[file.stem] = entry
+
+
+def _strict_schema(schema: Any) -> Any:
+    """Make a JSON schema from pydantic acceptable for strict structured outputs.
+
+    Every object must list all of its properties as required and forbid others,
+    and null defaults are left out.
+    """
+    if isinstance(schema, list):
+        return [_strict_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    strict = {
+        key: _strict_schema(value)
+        for key, value in schema.items()
+        if not (key == "default" and value is None)
+    }
+    if strict.get("type") == "object" and "properties" in strict:
+        strict["additionalProperties"] = False
+        strict["required"] = list(strict["properties"])
+    return strict
+
+
+# The structured output format of every request's response
+SUMMARY_FORMAT = {
+    "type": "json_schema",
+    "name": "Summary",
+    "schema": _strict_schema(Summary.model_json_schema()),
+    "strict": True,
+}
+
+
+def _request(name: str, entry: BatchEntry, model: str) -> dict[str, Any]:
+    """The line of the batch input file for the next request of an entry."""
+    return {
+        "custom_id": f"{name}:{entry.rounds}",
+        "method": "POST",
+        "url": "/v1/responses",
+        "body": {
+            "model": model,
+            "input": entry.input,
+            "tools": [nounproject.SEARCH_TOOL],
+            "text": {"format": SUMMARY_FORMAT},
+        },
+    }
+
+
+def submit(manifest: Manifest) -> BatchJob | None:
+    """Submit a batch with the next request of every pending entry."""
+    pending = [name for name, e in manifest.entries.items() if e.status == "pending"]
+    if not pending:
+        return None
+    lines = [
+        json.dumps(_request(name, manifest.entries[name], manifest.model))
+        for name in pending
+    ]
+    input_file = resilience.call(
+        "files.create",
+        oa.client().files.create,
+        hedge=False,
+        file=("batch.jsonl", io.BytesIO("\n".join(lines).encode("utf-8"))),
+        purpose="batch",
+    )
+    batch = resilience.call(
+        "batches.create",
+        oa.client().batches.create,
+        hedge=False,
+        input_file_id=input_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+    logger.info(f"Submitted batch {batch.id} with {len(pending)} requests")
+    job = BatchJob(id=batch.id, entries=pending, status=batch.status)
+    manifest.jobs.append(job)
+    for name in pending:
+        manifest.entries[name].status = "submitted"
+    return job
+
+
+def wait(job: BatchJob, poll_interval: float):
+    """Poll a batch until it is finished, returning it."""
+    while True:
+        batch = resilience.call(
+            "batches.retrieve", oa.client().batches.retrieve, batch_id=job.id
+        )
+        if batch.status != job.status:
+            logger.info(f"Batch {job.id} is {batch.status}")
+        job.status = batch.status
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        if batch.request_counts is not None:
+            counts = batch.request_counts
+            logger.debug(
+                f"Batch {job.id}: {counts.completed}/{counts.total} completed, "
+                f"{counts.failed} failed"
+            )
+        time.sleep(poll_interval)
+
+
+def _read_results(file_id: str | None) -> list[dict[str, Any]]:
+    if file_id is None:
+        return []
+    content = resilience.call(
+        "files.content", oa.client().files.content, file_id=file_id
+    )
+    return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+
+def _output_text(output: list[dict[str, Any]]) -> str | None:
+    for item in output:
+        if item["type"] == "message":
+            for content in item["content"]:
+                if content["type"] == "output_text":
+                    return content["text"]
+    return None
+
+
+def _search_all(calls: list[dict[str, Any]]) -> dict[str, str]:
+    """Run the searches requested across a whole round, by normalized query."""
+    queries: dict[str, dict[str, Any]] = {}
+    for item in calls:
+        arguments = json.loads(item["arguments"])
+        queries.setdefault(nounproject.normalize_query(arguments["query"]), arguments)
+    with ThreadPoolExecutor(max_workers=oa.TOOL_CALL_WORKERS) as pool:
+        outputs = pool.map(lambda kwargs: oa.run_search(**kwargs), queries.values())
+        return dict(zip(queries, outputs))
+
+
+def process_results(manifest: Manifest, job: BatchJob, batch):
+    """Apply the results of a finished batch to its entries."""
+    results = _read_results(batch.output_file_id) + _read_results(batch.error_file_id)
+    responses: dict[str, dict[str, Any]] = {}
+    for result in results:
+        name = result["custom_id"].rsplit(":", 1)[0]
+        entry = manifest.entries[name]
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            entry.status = "failed"
+            entry.error = json.dumps(result.get("error") or response.get("body"))
+            logger.warning(f"Request for {name} failed: {entry.error}")
+            continue
+        responses[name] = response["body"]
+
+    calls = {
+        name: [
+            item
+            for item in body["output"]
+            if item["type"] == "function_call" and item["name"] == "search_nounproject"
+        ]
+        for name, body in responses.items()
+    }
+    search_outputs = _search_all([item for items in calls.values() for item in items])
+
+    for name, body in responses.items():
+        entry = manifest.entries[name]
+        entry.rounds += 1
+        usage = body.get("usage")
+        if usage is not None:
+            tokens.record_usage(
+                manifest.model, usage["input_tokens"], usage["output_tokens"]
+            )
+        if not calls[name]:
+            text = _output_text(body["output"])
+            try:
+                assert text is not None, "Response has no output text"
+                entry.summary = Summary.model_validate_json(text)
+            except (AssertionError, ValueError) as e:
+                entry.status = "failed"
+                entry.error = f"Invalid response: {e}"
+                continue
+            entry.status = "generated"
+            continue
+
+        if entry.rounds > oa.MAX_FUNCTION_CALLING_ITERATIONS:
+            entry.status = "failed"
+            entry.error = (
+                "No definitive response recieved in "
+                f"{oa.MAX_FUNCTION_CALLING_ITERATIONS} iterations"
+            )
+            continue
+        # Send the model's output back with the results of the calls it made
+        entry.input.extend(body["output"])
+        for item in calls[name]:
+            arguments = json.loads(item["arguments"])
+            output = search_outputs[nounproject.normalize_query(arguments["query"])]
+            entry.tool_calls.append(
+                oa.ToolCall(name=item["name"], arguments=arguments, output=output)
+            )
+            entry.input.append(
+                {
+                    "type": "function_call_output",
+                    "call_id": item["call_id"],
+                    "output": output,
+                }
+            )
+        entry.status = "pending"
+
+    # Entries without a result are sent again if the batch completed regardless,
+    # a few times at most. If the batch failed, expired or was cancelled, resending
+    # them would most likely fail the same way.
+    for name in job.entries:
+        entry = manifest.entries[name]
+        if entry.status != "submitted":
+            continue
+        if batch.status == "completed" and entry.resubmissions < MAX_RESUBMISSIONS:
+            entry.resubmissions += 1
+            entry.status = "pending"
+        else:
+            entry.status = "failed"
+            entry.error = f"No result from batch {job.id}, which is {batch.status}"
+            logger.warning(f"Request for {name} failed: {entry.error}")
+    job.processed = True
+
+
+def write_outputs(name: str, entry: BatchEntry, out_dir: Path, formats: list[str]):
+    """Fetch icons for a generated summary and write it in each format."""
+    assert entry.summary is not None
+    ctx = Ctx()
+    ctx.input.file = entry.file
+    metadata, _ = summarization.read_input(ctx)
+    summary = Summary(metadata=metadata, bullets=[])
+    generation.fill_summary(summary, entry.summary, entry.tool_calls)
+    summarization.get_icon_contents(summary)
+    for format in formats:
+        ctx.output_format = format
+        ctx.output_file = out_dir / name / f"summary.{format}"
+        get_generator(format).generate(summary, ctx)
+        print(f"Generated file {ctx.output_file}")
+
+
+def run(
+    manifest_path: Path,
+    files: list[Path],
+    out_dir: Path,
+    formats: list[str],
+    poll_interval: float = 30,
+    model: str = generation.MODEL,
+    retry_failed: bool = False,
+) -> Manifest:
+    """Summarize every input through the Batch API, resuming from the manifest."""
+    manifest = Manifest.load(manifest_path, model)
+    add_inputs(manifest, files, retry_failed)
+    manifest.save(manifest_path)
+
+    while True:
+        job = next((j for j in manifest.jobs if not j.processed), None)
+        if job is None:
+            job = submit(manifest)
+            manifest.save(manifest_path)
+            if job is None:
+                break
+        else:
+            logger.info(f"Resuming batch {job.id}")
+        batch = wait(job, poll_interval)
+        process_results(manifest, job, batch)
+        manifest.save(manifest_path)
+
+    for name, entry in manifest.entries.items():
+        if entry.status != "generated":
+            continue
+        try:
+            write_outputs(name, entry, out_dir, formats)
+        except Exception as e:
+            logger.exception(f"Error writing outputs for {name}")
+            entry.status = "failed"
+            entry.error = str(e)
+        else:
+            entry.status = "done"
+        manifest.save(manifest_path)
+    return manifest
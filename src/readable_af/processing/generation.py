@@ -1,5 +1,7 @@
+from collections.abc import Sequence
+
 from readable_af.errors import AFException
-from ..external import openai as oa
+from ..external import openai as oa, resilience, tokens
 from readable_af.model.summary import (
     Metadata,
     Summary,
@@ -8,6 +10,10 @@ from ..logger import logger
 
 MODEL = "gpt-5-mini-2025-08-07"
 
+# Longer abstracts are trimmed before being sent, rather than failing (or costing)
+# at the API. Real abstracts are a few hundred tokens.
+MAX_ABSTRACT_TOKENS = 8_000
+
 
 def metadata_prompt(preamble: str) -> list[oa.Message]:
     return [
@@ -55,7 +61,7 @@ def abstract_prompt(messy_abstract: str) -> list[oa.Message]:
             "You should never respond with an answer other the specified text to be extracted",
             role="system",
         ),
-        oa.Message(content=messy_abstract),
+        oa.Message(content=tokens.trim(messy_abstract, MODEL, MAX_ABSTRACT_TOKENS)),
     ]
 
 
@@ -92,7 +98,7 @@ def summary_prompt(abstract: str) -> list[oa.Message]:
             "I expect that you will perform approximately 10-20 searches for each summary, but it may be as many as 30. ",
             role="system",
         ),
-        oa.Message(content=abstract),
+        oa.Message(content=tokens.trim(abstract, MODEL, MAX_ABSTRACT_TOKENS)),
     ]
 
 
@@ -106,29 +112,56 @@ def just_run_summary(abstract: str) -> Summary:
     return response
 
 
-def generate_bullets(summary: Summary, abstract: str) -> None:
+def generate_bullets(
+    summary: Summary,
+    abstract: str,
+    on_event: oa.OnEvent | None = None,
+    on_search: oa.OnSearch | None = None,
+) -> None:
     """Generate bullets for a summary using structured output from ChatGPT.
 
     This function uses OpenAI's structured output feature to ensure the response
     matches the expected format. The Summary structure is used directly, with Icon
     objects containing only keywords (IDs and URLs are left blank for post-processing).
+
+    :param on_event: If given, the response is streamed and progress is reported to it
+    :param on_search: Called with the results of each search the model makes
     """
     prompt = summary_prompt(abstract)
 
     try:
         # Use structured output with Summary directly - OpenAI fills in the full Summary structure
         # This guarantees valid JSON matching our schema
-        response = oa.completion_structured(prompt, response_model=Summary, model=MODEL)
+        run = oa.structured_run(
+            prompt,
+            response_model=Summary,
+            model=MODEL,
+            on_event=on_event,
+            on_search=on_search,
+        )
+        response = Summary.model_validate(run.output)
         logger.info(
             f"Generated structured summary: {response.model_dump_json(indent=2)}"
         )
+    except (tokens.TokenBudgetExceeded, resilience.DeadlineExceeded):
+        raise
     except Exception as e:
         logger.exception("Failed to generate structured output from ChatGPT")
         raise AFException(
             "ChatGPT is providing an invalid response. Please try again later."
         ) from e
 
-    # Populate the summary with the structured response
+    fill_summary(summary, response, run.tool_calls)
+
+
+def fill_summary(
+    summary: Summary, response: Summary, tool_calls: Sequence[oa.ToolCall] = ()
+) -> None:
+    """Populate a summary with the structured response generated for it.
+
+    :param tool_calls: The searches made to generate the response. Each icon's
+           alternates are the unused icons found by the search that found it.
+    """
     # Use simplified_title from response metadata if provided
     assert summary.metadata is not None, (
         "Summary metadata must be populated before generating bullets"
@@ -140,3 +173,13 @@ def generate_bullets(summary: Summary, abstract: str) -> None:
     # Icons will have only the keyword field populated; IDs/URLs are filled in post-processing
     summary.bullets = response.bullets
     summary.rating = response.rating
+    _set_alternates(summary, tool_calls)
+
+
+def _set_alternates(summary: Summary, tool_calls: Sequence[oa.ToolCall]):
+    searches = [oa.search_output_ids(call.output) for call in tool_calls]
+    used = {icon.id for bullet in summary.bullets for icon in bullet.icons}
+    for bullet in summary.bullets:
+        for icon in bullet.icons:
+            found_with = next((ids for ids in searches if icon.id in ids), [])
+            icon.set_alternates([id for id in found_with if id not in used])
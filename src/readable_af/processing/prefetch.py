@@ -0,0 +1,72 @@
+"""Speculative downloads of icons while a summary is still being generated.
+
+The model picks its icons from the results of its searches, usually from the
+top of them. As each search finishes, the top results are downloaded in the
+background, so that by the time the summary arrives most of its icons are
+already in the cache and the download stage has little left to do.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from ..external import nounproject, resilience
+from ..external import openai as oa
+from ..logger import logger
+
+# Icons downloaded from the top of each search's results
+PREFETCH_PER_SEARCH = 2
+# Most icons downloaded for one summary. Each one that isn't used costs a request.
+PREFETCH_BUDGET = 24
+PREFETCH_WORKERS = 4
+
+
+class IconPrefetcher:
+    """Download the top icons of each search in the background, within a budget.
+
+    Use as a context manager around generation, passing `on_search` to it.
+    Downloads that haven't started by the time the block exits are cancelled.
+    """
+
+    def __init__(
+        self,
+        per_search: int = PREFETCH_PER_SEARCH,
+        budget: int = PREFETCH_BUDGET,
+        workers: int = PREFETCH_WORKERS,
+    ):
+        self.per_search = per_search
+        self.budget = budget
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._futures: dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def on_search(self, query: str, output: str):
+        """Start downloading the top results of a search."""
+        ids = oa.search_output_ids(output)[: self.per_search]
+        with self._lock:
+            for icon_id in ids:
+                if self._closed or len(self._futures) >= self.budget:
+                    return
+                if icon_id not in self._futures:
+                    logger.debug(f"Prefetching icon {icon_id} for '{query}'")
+                    self._futures[icon_id] = self._pool.submit(
+                        resilience.in_context(nounproject.get_icon_hash), icon_id
+                    )
+
+    def close(self):
+        """Cancel the downloads that haven't started. Started ones finish."""
+        with self._lock:
+            self._closed = True
+            n_cancelled = sum(future.cancel() for future in self._futures.values())
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._futures:
+            logger.info(
+                f"Prefetched {len(self._futures) - n_cancelled} icons "
+                f"({n_cancelled} cancelled)"
+            )
+
+    def __enter__(self) -> "IconPrefetcher":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
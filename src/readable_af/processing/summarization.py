@@ -1,25 +1,103 @@
 """High-level API for summarization."""
 
+import queue
+import threading
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, Literal
 
 import yaml
+from pydantic import BaseModel, Field
+from pydantic_core import from_json
 
 from ..model.request import Ctx
 
-from ..external import nounproject
-from ..model.summary import Bullet, Metadata, Summary
+from ..external import blobs, nounproject, resilience
+from ..logger import logger
+from ..model.summary import Bullet, Icon, Metadata, Summary
 from . import generation
+from .prefetch import IconPrefetcher
+
+# Only the first icons of each bullet are shown, so only those are downloaded
+ICONS_PER_BULLET = 2
+# How many icons are downloaded at once
+ICON_WORKERS = 8
+# How many icons are tried for each one shown: the chosen one, then its alternates
+ICON_ATTEMPTS = 3
+
+
+class Event(BaseModel):
+    """Progress made while generating a summary, as reported by `summarize_events`."""
+
+    kind: Literal["progress", "bullet", "icon", "summary"]
+    data: dict[str, Any] = Field(default_factory=dict)
+    # Only set on the final "summary" event
+    summary: Summary | None = Field(default=None, exclude=True)
+
+
+def _shown_icons(summary: Summary) -> list[Icon]:
+    return [
+        icon for bullet in summary.bullets for icon in bullet.icons[:ICONS_PER_BULLET]
+    ]
+
+
+def download_icon(icon: Icon) -> str | None:
+    """Download an icon, falling back on its alternates if it can't be downloaded.
+
+    If an alternate is used, the icon's ID is changed to it.
+
+    :returns: The hash of the icon's image in the blob store
+    """
+    for icon_id in [icon.id, *icon.alternates][:ICON_ATTEMPTS]:
+        try:
+            digest = nounproject.get_icon_hash(icon_id)
+        except Exception as e:
+            logger.warning(f"Error fetching icon {icon_id}: {e}")
+            continue
+        if digest is None:
+            logger.warning(f"Icon {icon_id} could not be downloaded")
+            continue
+        if icon_id != icon.id:
+            logger.info(f"Using icon {icon_id} in place of {icon!r}")
+            icon.id = icon_id
+        return digest
+    return None
 
 
 def get_icon_contents(summary: Summary):
-    for bullet in summary.bullets:
-        for icon in bullet.icons:
-            contents = nounproject.get_icon(icon_id=icon.id)
-            assert contents is not None
-            icon.populate(contents)
+    """Download the icons that are shown, in parallel.
+
+    Icons that can't be downloaded (nor any of their alternates) are dropped from
+    their bullet, and the next icon of the bullet is shown instead.
+    """
+    while icons := [icon for icon in _shown_icons(summary) if not icon.up_to_date()]:
+        # Cached icons take a single cache lookup
+        cached = nounproject.get_icon_hash.get_many(
+            [{"icon_id": icon.id} for icon in icons], compute_missing=False
+        )
+        missing = []
+        for icon, digest in zip(icons, cached):
+            if digest is None:
+                missing.append(icon)
+            else:
+                icon.populate(digest)
+        with ThreadPoolExecutor(max_workers=ICON_WORKERS) as pool:
+            downloaded = list(pool.map(resilience.in_context(download_icon), missing))
 
+        failed = set()
+        for icon, digest in zip(missing, downloaded):
+            if digest is None:
+                logger.warning(f"Dropping {icon!r}, which could not be downloaded")
+                failed.add(id(icon))
+            else:
+                icon.populate(digest)
+        for bullet in summary.bullets:
+            bullet.icons = [icon for icon in bullet.icons if id(icon) not in failed]
 
-def summarize(ctx: Ctx) -> Summary:
+
+def read_input(ctx: Ctx) -> tuple[Metadata, str]:
+    """Get the metadata and abstract of the document to summarize."""
     # Get the file extension from the input file
     input = ctx.input
     if input.abstract is None:
@@ -46,15 +124,157 @@ def summarize(ctx: Ctx) -> Summary:
             date="",
             simplified_title="",
         )
+    return metadata, abstract
+
 
+def summarize(ctx: Ctx) -> Summary:
+    metadata, abstract = read_input(ctx)
     summary = Summary(metadata=metadata, bullets=[])
-    generation.generate_bullets(summary, abstract)
+    # Icons start downloading as the model finds them, and the rest afterwards
+    with IconPrefetcher() as prefetcher:
+        generation.generate_bullets(summary, abstract, on_search=prefetcher.on_search)
 
     get_icon_contents(summary)
 
     return summary
 
 
+def _completed_bullets(output: str) -> list[Bullet]:
+    """Parse the bullets that are complete in a partially generated summary."""
+    try:
+        parsed = from_json(output, allow_partial=True)
+    except ValueError:
+        return []
+    if not isinstance(parsed, dict):
+        return []
+    # The last bullet may still be being generated
+    bullets = parsed.get("bullets", [])[:-1]
+    try:
+        return [Bullet.model_validate(bullet) for bullet in bullets]
+    except ValueError:
+        return []
+
+
+def _icon_event(i_bullet: int, i_icon: int, icon_id: int, digest: str) -> Event:
+    return Event(
+        kind="icon",
+        data={
+            "bullet": i_bullet,
+            "icon": i_icon,
+            "id": icon_id,
+            "src": blobs.data_uri(digest),
+        },
+    )
+
+
+def summarize_events(ctx: Ctx) -> Iterator[Event]:
+    """Summarize a document, yielding each bullet and icon as soon as it is ready.
+
+    The summary is generated in a background thread with a streamed response.
+    Bullets are yielded as they are completed in the model's output, and their
+    icons are downloaded while the rest of the summary is generated. The final
+    event is a "summary" event holding the complete, populated summary.
+    """
+    metadata, abstract = read_input(ctx)
+    summary = Summary(metadata=metadata, bullets=[])
+    events: queue.Queue[tuple[str, Any]] = queue.Queue()
+
+    def generate():
+        try:
+            with IconPrefetcher() as prefetcher:
+                generation.generate_bullets(
+                    summary,
+                    abstract,
+                    on_event=lambda kind, data: events.put((kind, data)),
+                    on_search=prefetcher.on_search,
+                )
+            events.put(("done", None))
+        except BaseException as e:
+            events.put(("error", e))
+
+    yield Event(kind="progress", data={"message": "Writing summary"})
+    threading.Thread(target=resilience.in_context(generate), daemon=True).start()
+
+    # Each attempt at a response streams the summary from the start
+    turn = 0
+    output = ""
+    n_bullets = 0
+    n_icons_pending = 0
+    # The streamed icon at each (bullet, position), the ID it was chosen with
+    # (before any alternate replaced it), and the hash of its image
+    streamed_icons: dict[tuple[int, int], tuple[int, Icon, str]] = {}
+    done = False
+
+    with ThreadPoolExecutor(max_workers=ICON_WORKERS) as pool:
+
+        def fetch_icons(bullets: list[Bullet]):
+            """Emit new bullets and start downloading their icons."""
+            nonlocal n_bullets, n_icons_pending
+            for bullet in bullets[n_bullets:]:
+                yield Event(
+                    kind="bullet", data={"index": n_bullets, "text": bullet.text}
+                )
+                for i_icon, icon in enumerate(bullet.icons[:ICONS_PER_BULLET]):
+                    future = pool.submit(resilience.in_context(download_icon), icon)
+                    future.add_done_callback(
+                        lambda f, key=(turn, n_bullets, i_icon, icon, icon.id): (
+                            events.put(("icon", (key, f)))
+                        )
+                    )
+                    n_icons_pending += 1
+                n_bullets += 1
+
+        while not done or n_icons_pending:
+            kind, data = events.get()
+            if kind == "error":
+                raise data
+            if kind == "done":
+                done = True
+                yield from fetch_icons(summary.bullets)
+            elif kind == "turn":
+                # A retry; what the previous attempt streamed no longer applies
+                turn += 1
+                output = ""
+                n_bullets = 0
+                streamed_icons.clear()
+            elif kind == "search":
+                yield Event(
+                    kind="progress",
+                    data={"message": f"Searching for icons: {data['query']}"},
+                )
+            elif kind == "output_delta":
+                output += data["delta"]
+                yield from fetch_icons(_completed_bullets(output))
+            elif kind == "icon":
+                (icon_turn, i_bullet, i_icon, icon, chosen_id), future = data
+                n_icons_pending -= 1
+                if icon_turn != turn:
+                    continue
+                try:
+                    digest = future.result()
+                except Exception as e:
+                    logger.warning(f"Error fetching icon {chosen_id}: {e}")
+                    continue
+                if digest is None:
+                    continue
+                streamed_icons[(i_bullet, i_icon)] = (chosen_id, icon, digest)
+                # The icon's ID is that of the alternate used, if it was replaced
+                yield _icon_event(i_bullet, i_icon, icon.id, digest)
+
+    # The final response is authoritative; anything that differs from what was
+    # streamed is fetched now
+    for i_bullet, bullet in enumerate(summary.bullets):
+        for i_icon, icon in enumerate(bullet.icons[:ICONS_PER_BULLET]):
+            streamed = streamed_icons.get((i_bullet, i_icon))
+            if streamed is not None and streamed[0] == icon.id:
+                _, streamed_icon, digest = streamed
+                icon.id = streamed_icon.id
+                icon.populate(digest)
+    get_icon_contents(summary)
+
+    yield Event(kind="summary", data=summary.asdict(), summary=summary)
+
+
 def reload(input_file: Path) -> Summary:
     with input_file.open() as f:
         input = yaml.safe_load(f)
@@ -1,7 +1,10 @@
 """Attempt to extract abstracts from an academic PDF"""
 
+import hashlib
 import re
-from functools import lru_cache
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
 from pathlib import Path
 
 from pypdf import PdfReader
@@ -22,16 +25,57 @@ KNOWN_SECTIONS = (
 )
 
 N_PAGES = 3
+# Files whose extracted text is kept in memory
+N_CACHED_FILES = 16
 
 
-# Cache only the most recent file
-@lru_cache(maxsize=1)
-def _extract_pdf_text(pdf_file: Path) -> str:
-    reader = PdfReader(pdf_file)
-    pages = []
-    for page in reader.pages[:N_PAGES]:
-        pages.append(page.extract_text())
-    return " ".join(pages)
+class _PageCache:
+    """Text extracted from the pages of recently read files, by content hash.
+
+    A file's entry holds the pages extracted so far, so a file whose abstract was
+    found on its first page only ever has that page parsed.
+    """
+
+    def __init__(self, max_files: int):
+        self.max_files = max_files
+        self._files: OrderedDict[str, list[str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pages(self, digest: str) -> list[str]:
+        with self._lock:
+            if digest in self._files:
+                self._files.move_to_end(digest)
+            else:
+                self._files[digest] = []
+                while len(self._files) > self.max_files:
+                    self._files.popitem(last=False)
+            return self._files[digest]
+
+    def add(self, pages: list[str], index: int, text: str):
+        with self._lock:
+            # Another reader of the same file may have got there first
+            if len(pages) == index:
+                pages.append(text)
+
+
+_page_cache = _PageCache(N_CACHED_FILES)
+
+
+def _extract_pdf_pages(pdf_file: Path) -> Iterator[str]:
+    """Yield the text of each of the first N_PAGES pages, extracting them lazily."""
+    with pdf_file.open("rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    pages = _page_cache.pages(digest)
+    reader = None
+    for i in range(N_PAGES):
+        if i >= len(pages):
+            if reader is None:
+                reader = PdfReader(pdf_file)
+            if i >= len(reader.pages):
+                return
+            logger.debug(f"Extracting text from page {i + 1} of {pdf_file}")
+            _page_cache.add(pages, i, reader.pages[i].extract_text())
+        yield pages[i]
 
 
 def find_section_index(text: str, section: str, start_idx=0) -> int:
@@ -65,10 +109,38 @@ def find_section_index(text: str, section: str, start_idx=0) -> int:
     return -1
 
 
+def _next_section_index(text: str, start_idx: int) -> int:
+    """Find the first section heading after `start_idx`, or -1 if there is none."""
+    indices = [
+        find_section_index(text, section, start_idx) for section in KNOWN_SECTIONS
+    ]
+    return min((i for i in indices if i > start_idx), default=-1)
+
+
+def _checked_abstract(text: str, start_idx: int, end_idx: int) -> str:
+    if end_idx - start_idx > 4192:
+        logger.error("Abstract is impossibly long. Refusing to process!")
+        raise ValueError("Abstract is too long")
+    return text[start_idx:end_idx]
+
+
 def find_abstract(input_file: Path) -> str:
-    """Return a portion of the article that likely contains the abstract"""
+    """Return a portion of the article that likely contains the abstract
+
+    Pages are read one at a time, stopping once the abstract and the heading
+    that follows it have been found.
+    """
     logger.info(f"Attempting to find abstract in {input_file}")
-    paper_text = _extract_pdf_text(input_file)
+    paper_text = ""
+    for page in _extract_pdf_pages(input_file):
+        paper_text = f"{paper_text} {page}" if paper_text else page
+        abstract_ind = find_section_index(paper_text, "abstract")
+        if abstract_ind == -1:
+            continue
+        next_ind = _next_section_index(paper_text, abstract_ind)
+        if next_ind != -1:
+            return _checked_abstract(paper_text, abstract_ind, next_ind)
+
     abstract_ind = find_section_index(paper_text, "abstract")
     if abstract_ind == -1:
         logger.warn(
@@ -90,13 +162,7 @@ def find_abstract(input_file: Path) -> str:
         return paper_text[:intro_ind]
 
     # Find the next section heading after the abstract
-    next_ind = len(paper_text)
-    for section in KNOWN_SECTIONS:
-        section_ind = find_section_index(paper_text, section, abstract_ind)
-        if section_ind > abstract_ind and section_ind < next_ind:
-            next_ind = section_ind
-
-    if next_ind - abstract_ind > 4192:
-        logger.error("Abstract is impossibly long. Refusing to process!")
-        raise ValueError("Abstract is too long")
-    return paper_text[abstract_ind:next_ind]
+    next_ind = _next_section_index(paper_text, abstract_ind)
+    if next_ind == -1:
+        next_ind = len(paper_text)
+    return _checked_abstract(paper_text, abstract_ind, next_ind)
@@ -5,7 +5,6 @@ import tempfile
 from pathlib import Path
 
 import flask
-import requests
 from flask import (
     Flask,
     Response,
@@ -13,12 +12,14 @@ from flask import (
     render_template,
     request,
 )
+from flask.typing import ResponseReturnValue
 from flask_limiter import Limiter, RequestLimit
 from flask_limiter.util import get_remote_address
 
 from readable_af.output import gdocs
 
 from . import api
+from .external import cache_stats, http
 from .config import Config
 from .logger import logger, setup_logging
 from .model.request import Ctx
@@ -33,7 +34,7 @@ else:
 
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+app.secret_key = Config.get().flask_secret_key
 # app.config['SERVER_NAME'] = 'readable-af.fly.dev'
 app.config["SESSION_TYPE"] = "filesystem"
 
@@ -87,9 +88,17 @@ def summarize():
     )
 
 
-@app.route("/api/summarize", methods=["GET", "POST"])
-@limiter.limit("10 per 1 minute")  # <------------ New line
-def summarize_file():
+# Give up on a request in time to report an error before gunicorn kills the worker
+LATENCY_BUDGET = 90
+
+ERROR_MESSAGE = "Sorry, an error has occurred. Please email deborah.levy@princeton.edu to report this error."
+
+
+def _ctx_from_form() -> Ctx | ResponseReturnValue:
+    """Build the context for a summarization request from the submitted form.
+
+    Returns the response to send instead if the request can't be summarized.
+    """
     credentials = gdocs.get_credentials()
     if not credentials:
         flash("Sorry, your authentication with google has expired. Please log in again")
@@ -98,25 +107,32 @@ def summarize_file():
     if "g-recaptcha-response" not in request.form:
         logger.warning("No recaptcha response")
         # return "Sorry, you are not human!"
-        return "Sorry, an error has occurred. Please email deborah.levy@princeton.edu to report this error."
+        return ERROR_MESSAGE
 
     captcha_response = request.form["g-recaptcha-response"]
     if not is_human(captcha_response):
         logger.warning("Recapcha failed")
         # return "Sorry, you are not human!"
-        return "Sorry, an error has occurred. Please email deborah.levy@princeton.edu to report this error."
+        return ERROR_MESSAGE
+
+    ctx = Ctx()
+    ctx.credentials = credentials
+    ctx.input.abstract = request.form["abstract"]
+    ctx.input.authors = request.form["authors"]
+    ctx.input.title = request.form["title"]
+    ctx.output_format = "gdoc"
+    ctx.latency_budget = LATENCY_BUDGET
+    return ctx
+
 
-    abstract = request.form["abstract"]
-    title = request.form["title"]
-    authors = request.form["authors"]
+@app.route("/api/summarize", methods=["GET", "POST"])
+@limiter.limit("10 per 1 minute")  # <------------ New line
+def summarize_file():
+    ctx = _ctx_from_form()
+    if not isinstance(ctx, Ctx):
+        return ctx
 
     try:
-        ctx = Ctx()
-        ctx.credentials = credentials
-        ctx.input.abstract = abstract
-        ctx.input.authors = authors
-        ctx.input.title = title
-        ctx.output_format = "gdoc"
         with tempfile.TemporaryDirectory() as tmp_out:
             ctx.output_file = Path(tmp_out) / "summary"
             api.summarize(ctx)
@@ -135,6 +151,56 @@ def summarize_file():
     )
 
 
+def _sse(event: str, data: dict) -> str:
+    """Format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/api/summarize/stream", methods=["POST"])
+@limiter.limit("10 per 1 minute")
+def summarize_stream():
+    """Summarize the submitted form, streaming progress as server-sent events.
+
+    Emits "progress", "bullet", "icon" and "summary" events as the summary is
+    generated, then a "done" event with the link to the output, or an "error" event.
+    """
+    ctx = _ctx_from_form()
+    if not isinstance(ctx, Ctx):
+        return ctx
+
+    def stream():
+        try:
+            with tempfile.TemporaryDirectory() as tmp_out:
+                ctx.output_file = Path(tmp_out) / "summary"
+                for event in api.summarize_events(ctx):
+                    yield _sse(event.kind, event.data)
+            assert ctx.output_link is not None
+        except Exception as e:
+            logger.exception(f"Error summarizing: {e}")
+            yield _sse("error", {"message": str(e)})
+            return
+        yield _sse("done", {"output_link": ctx.output_link})
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        # Keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/cache/stats", methods=["GET"])
+@limiter.limit("60 per 1 minute")
+def cache_stats_json():
+    """Hit/miss counters and latencies of the cache in this worker.
+
+    Only served if `Config.expose_cache_stats` is set.
+    """
+    if not Config.get().expose_cache_stats:
+        flask.abort(404)
+    return flask.jsonify(cache_stats.snapshot())
+
+
 def is_human(captcha_response):
     """Validating recaptcha response from google server
     Returns True captcha test passed for submitted form else returns False.
@@ -142,7 +208,7 @@ def is_human(captcha_response):
     logger.debug(f"Capcha response: {captcha_response}")
     secret = Config.get().recapcha_secret
     payload = {"response": captcha_response, "secret": secret}
-    response = requests.post("https://www.google.com/recaptcha/api/siteverify", payload)
+    response = http.post(Config.get().recaptcha_verify_url, payload)
     response_text = json.loads(response.text)
     logger.debug(f"Response text: {response_text}")
     return response_text["success"]